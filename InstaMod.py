@@ -3,21 +3,19 @@
 # Python imports
 import praw
 import prawcore
+import os
+import signal
 import sys
+import threading
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 from collections import Counter, OrderedDict
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from dateutil import relativedelta
 import dateutil.parser
-import nltk
-from nltk.tokenize import sent_tokenize
 from tinydb import TinyDB, Query
 
-# File system imports
-from sub import Subreddit
-from user import User
-
 # List of subs for parsing folders
 master_list = [
 	'CryptoCurrency',
@@ -25,11 +23,57 @@ master_list = [
 	'CryptoTechnology'
 ]
 
+# 'auto N' splits the subs between N worker processes
+# The supervisor is started before anything below logs in to Reddit or opens a database, so it needs no praw.ini site of its own
+from supervisor import supervise
+if __name__ == '__main__' and sys.argv[1:2] == ['auto'] and len(sys.argv) > 2 and 'INSTAMOD_SUBS' not in os.environ:
+	if not sys.argv[2].isdigit() or int(sys.argv[2]) < 1:
+		print('Usage: InstaMod.py auto [number of worker processes]')
+		sys.exit(1)
+	if int(sys.argv[2]) > 1:
+		supervise(os.path.abspath(__file__), master_list, int(sys.argv[2]))
+		sys.exit()
+
+# File system imports
+from sub import Subreddit, userKey, setUser, getReddit
+from user import User
+from storage import MessageLog, CommentLog
+from throttle import TokenBucket, throttled
+from pipeline import AnalysisQueue
+from aggregate import HistoryAggregator, addTotals
+from rules import accountAgeText
+from retier import retierSub
+from qc import getQCCounter
+from metrics import metrics, startMetrics, dumpMetrics
+
+# Worker processes started by the supervisor only run their own share of the subs
+if 'INSTAMOD_SUBS' in os.environ:
+	master_list = os.environ['INSTAMOD_SUBS'].split(',')
+
 # Save current time
 current_time = datetime.now()
 
-# Start instance of Reddit
-reddit = praw.Reddit('InstaMod')
+# Start the main thread's instance of Reddit, every other thread makes its own with getReddit
+reddit = getReddit()
+
+# Shared by every thread making API requests
+api_bucket = TokenBucket(reddit)
+
+# PM commands already handled, so they are never run twice
+message_log = MessageLog('shared/messages.db')
+
+# Comments handled by the stream, for skipping repeats and reading back comments missed while the bot was down
+comment_log = CommentLog('shared/comments.db')
+# Seconds of comments before each sub's checkpoint that are remembered for skipping repeats
+comment_window = 86400
+# Errors reaching Reddit, a comment that hits one is handled again once the stream reconnects
+connection_errors = (prawcore.exceptions.RequestException, prawcore.exceptions.ServerError, prawcore.exceptions.TooManyRequests)
+# Connection errors are retried this many times for one comment before it is given up on
+comment_retries = 3
+comment_failures = {}
+
+# Held while a comment is handled, so PM commands and config updates do not change a sub part way through a comment
+stream_lock = threading.Lock()
 
 # Initiate TinyDB Querry
 find_stuff = Query()
@@ -41,13 +85,6 @@ def setSubs():
 		sub_list[sub] = Subreddit(sub)
 	return sub_list
 
-# Ensures user is accessible to the bot
-def setUser(username):
-	try:
-		return reddit.redditor(username)
-	except (prawcore.exceptions.NotFound, AttributeError):
-		return None
-
 # Ensures that a string consists of a number only
 def checkIsInt(target_str):
 	try:
@@ -59,202 +96,285 @@ def checkIsInt(target_str):
 # Main method for finding users to analyze
 def sortComment(sub_dict, comment):
 	parent_sub = sub_dict[str(comment.subreddit)]
-	sub = parent_sub.sub_obj
 	user = comment.author
 	username = str(user)
+	stages = metrics.stages('sortComment')
 	post = comment.submission
 	post_flair = post.link_flair_text
-	
+	stages.lap('post')
 
 	# Sorts user for instant analysis or expired flair
 	if parent_sub.checkUser(user) == True:
-		print('Found comment from User: ' + username + '\tSubreddit: ' + str(sub))
-		flair = next(parent_sub.sub_obj.flair(user))['flair_text']
+		print('Found comment from User: ' + username + '\tSubreddit: ' + parent_sub.sub_name)
+		flair = parent_sub.getFlair(user)[0]
 		if flair != '' and flair != None:
 			parent_sub.addExpired(user)
 		else:
-			analyzeUsers(parent_sub, [user])
+			analysis_queue.put(parent_sub, [user])
+	stages.lap('check_user')
 			
 	# Store comment for ratelimit count
 	if parent_sub.main_config['ratelimit'] == True:
-		parent_sub.checkInterval()
-		parent_sub.ratelimit[username] += 1
+		parent_sub.recordComment(username)
+	stages.lap('ratelimit_count')
 
 	# 'INSTANT' or any number
 	update_interval = parent_sub.main_config['update_interval']
 
-	# If update interval is set to instant then immediately flair users
+	# If update interval is set to instant then immediately queue users for flair
 	if update_interval == 'INSTANT':
-		analyzeUsers(parent_sub, parent_sub.expired_users)
-		parent_sub.dropExpired()
+		if len(parent_sub.expired_users) > 0:
+			analysis_queue.put(parent_sub, list(parent_sub.expired_users.values()))
+			parent_sub.dropExpired()
 
 	# If update interval is set to a number, check if the expired users list is over that number
 	elif len(parent_sub.expired_users) > update_interval:
-			print ('\nAnalyzing all users in expired list: ' + str(len(parent_sub.expired_users)) + '\n')
-			analyzeUsers(parent_sub, parent_sub.expired_users)
+			print ('\nQueueing all users in expired list: ' + str(len(parent_sub.expired_users)) + '\n')
+			analysis_queue.put(parent_sub, list(parent_sub.expired_users.values()))
 			parent_sub.dropExpired()
+	stages.lap('expired')
 			
-	# Holds user profile data
-	user_info = None
+	# Skip reading user info when no rule applies to this comment
+	lock_rule = None
+	if parent_sub.main_config['thread_lock'] == True and post_flair != None:
+		lock_rule = parent_sub.threadlock_rules.get(post_flair)
+	if lock_rule == None and parent_sub.main_config['sub_lock'] != True and parent_sub.main_config['ratelimit'] != True:
+		return
+
+	comment_info = {'fullname' : comment.fullname, 'username' : username, 'body' : comment.body, 'post_title' : post.title, 'post_flair' : post_flair, 'rate_counts' : rateCounts(parent_sub, username)}
+	user_info = parent_sub.getUserInfo(username)
+	# Comments from users waiting to be analyzed are checked once the analysis is done
+	if user_info == None:
+		# Stored users are analyzed again when their history has not been counted with the sub's current QC settings
+		if userKey(user) in parent_sub.current_users:
+			analysis_queue.put(parent_sub, [user])
+		if analysis_queue.hold(parent_sub, user, comment_info):
+			metrics.count('sortComment.held')
+			return
+		# The user may have been analyzed since their info was read
+		user_info = parent_sub.getUserInfo(username)
+		if user_info == None:
+			return
+	moderateComment(parent_sub, comment, user, comment_info, user_info, stages)
+
+# Comments from the user in each ratelimit rule's interval, read when the comment is handled
+def rateCounts(parent_sub, username):
+	if parent_sub.main_config['ratelimit'] != True:
+		return {}
+	return dict((rate_rule.interval, parent_sub.ratelimiter.count(userKey(username), rate_rule.interval * 3600.0)) for rate_rule in parent_sub.ratelimit_rules)
+
+# Check a comment against the thread lock, sub lock and ratelimit rules
+# comment_info holds the comment's text, its post and the author's comment counts from when it was handled
+def moderateComment(parent_sub, comment, user, comment_info, user_info, stages):
+	post_flair = comment_info['post_flair']
 
 	# Check comment for Thread Lock
 	if parent_sub.main_config['thread_lock'] == True:
 			if post_flair != None:
-				lock_status = checkThreadLock(parent_sub, post.link_flair_text)
-				if lock_status != None:
-					user_info = parent_sub.getUserInfo(username)
-					
-					if user_info != None and handelThreadLock(parent_sub, lock_status, user_info):
-						lock_type = parent_sub.threadlock_config[lock_status]
-						action = lock_type['action']
-
-						if action == 'REMOVE':
+				lock_rule = parent_sub.threadlock_rules.get(post_flair)
+				if lock_rule != None:
+					if lock_rule.check(user_info):
+						if lock_rule.action == 'REMOVE':
 							message_info = parent_sub.threadlock_config['remove_message']
 							if message_info != None:
-								user.message(message_info[0], ("\n\nSubreddit: " + parent_sub.sub_name + "\n\nPost: " + post.title + "\n\nLock Type: " + lock_type['flair_ID'] + "\n\nComment: " + comment.body + "\n\n" + message_info[1]))
-								comment.mod.remove()
-								print ('Comment removed and user notified')
-						elif action == 'SPAM':
+								user.message(message_info[0], ("\n\nSubreddit: " + parent_sub.sub_name + "\n\nPost: " + comment_info['post_title'] + "\n\nLock Type: " + lock_rule.lock_ID + "\n\nComment: " + comment_info['body'] + "\n\n" + message_info[1]))
+							comment.mod.remove()
+							print ('Comment removed under thread lock')
+						elif lock_rule.action == 'SPAM':
 							comment.mod.remove(spam=True)
+	stages.lap('thread_lock')
 
 	# Check comment for Sub Lock
 	if parent_sub.main_config['sub_lock'] == True:
-		if user_info == None:
-			user_info = parent_sub.getUserInfo(username)
-		if user_info != None:
-			user_locked = handelSubLock(parent_sub, user_info)
-			
-			if user_locked != False:
-				lock_type = parent_sub.sublock_config[user_locked]
-				action = lock_type['action']
-
-				if action == 'REMOVE':
-					message_info = parent_sub.threadlock_config['remove_message']
-					if message_info != None:
-						user.message(message_info[0], ("\n\nSubreddit: " + parent_sub.sub_name + "\n\nPost: " + post.title + "\n\nLock Type: " + lock_type['lock_ID'] + "\n\nComment: " + comment.body + "\n\n" + message_info[1]))
-						comment.mod.remove()
-						print ('Comment removed and user notified')
-				elif action == 'SPAM':
-					comment.mod.remove(spam=True)
+		lock_rule = handelSubLock(parent_sub, user_info)
+		
+		if lock_rule != None:
+			if lock_rule.action == 'REMOVE':
+				message_info = parent_sub.sublock_config['remove_message']
+				if message_info != None:
+					user.message(message_info[0], ("\n\nSubreddit: " + parent_sub.sub_name + "\n\nPost: " + comment_info['post_title'] + "\n\nLock Type: " + lock_rule.lock_ID + "\n\nComment: " + comment_info['body'] + "\n\n" + message_info[1]))
+				comment.mod.remove()
+				print ('Comment removed under sub lock')
+			elif lock_rule.action == 'SPAM':
+				comment.mod.remove(spam=True)
+	stages.lap('sub_lock')
 					
 	# Check comment for Ratelimit
 	if parent_sub.main_config['ratelimit'] == True:
-		if user_info == None:
-			user_info = parent_sub.getUserInfo(username)
-		if user_info != None:
-			for tag, config in parent_sub.ratelimit_config.items():
-			
-				if tag.startswith('comments') and checkInfoTag(parent_sub, user_info, config):
-					max_comm = config['max']
-					user_comm = parent_sub.ratelimit[username]
-					
-					if user_comm > max_comm:
-						remove_message = sub.ratelimit_config['remove_message']
-						if config['action'] == 'REMOVE':
-							if remove_message != None:
-								user.message('Your comment on /r/' + parent_sub.sub_name + ' has been automatically removed', ("\n\nSubreddit: " + parent_sub.sub_name + "\n\nPost: " + post.title + "\n\nComment Rate Limit: Over " + str(max_comm) + ' comments in under ' + str(config['interval']) + ' hours' + "\n\nComment: " + comment.body + "\n\n" + remove_message))
-							comment.mod.remove()
-						if config['action'] == 'SPAM':
-							comment.mod.remove(spam=True)
+		for rate_rule in parent_sub.ratelimit_rules:
+		
+			if rate_rule.check(user_info):
+				max_comm = rate_rule.max
+				user_comm = comment_info['rate_counts'].get(rate_rule.interval, 0)
+				
+				if user_comm > max_comm:
+					remove_message = parent_sub.ratelimit_config['remove_message']
+					if rate_rule.action == 'REMOVE':
+						if remove_message != None:
+							user.message('Your comment on /r/' + parent_sub.sub_name + ' has been automatically removed', ("\n\nSubreddit: " + parent_sub.sub_name + "\n\nPost: " + comment_info['post_title'] + "\n\nComment Rate Limit: Over " + str(max_comm) + ' comments in under ' + str(rate_rule.interval) + ' hours' + "\n\nComment: " + comment_info['body'] + "\n\n" + remove_message))
+						comment.mod.remove()
+					if rate_rule.action == 'SPAM':
+						comment.mod.remove(spam=True)
+	stages.lap('ratelimit')
+
+# Check the comments held while their authors were analyzed, under stream_lock like comments from the stream
+# The comment and author are made again from this thread's Reddit instance, which loads them lazily
+def releaseComments(parent_sub, held_comments):
+	with stream_lock:
+		for comment_info in held_comments:
+			user_info = parent_sub.getUserInfo(comment_info['username'])
+			if user_info == None:
+				metrics.count('heldComment.unchecked')
+				continue
+			try:
+				comment = getReddit().comment(id=comment_info['fullname'][3:])
+				moderateComment(parent_sub, comment, setUser(comment_info['username']), comment_info, user_info, metrics.stages('heldComment'))
+				metrics.count('heldComment.checked')
+			except Exception as error:
+				print('\nHeld comment ' + comment_info['fullname'] + ' failed: ' + repr(error))
+				metrics.count('heldComment.errors')
 		
 # Analyze a user's comments and posts and extract data from them
-def analyzeHistory(parent_sub, user):
+# Raw per subreddit totals are kept in the shared history with a mark of the newest item seen, so re-analysis only fetches newer items
+# Items younger than score_settle hours are still being voted on, so the mark stays behind them and their totals are kept
+# apart as well, to be taken back out and read again with their new scores on the next analysis
+# QC is counted in the same pass for the QC settings of every sub, settings no sub uses any more are dropped
+# account is the user's (created, comment karma, link karma) from getAccount
+def analyzeHistory(parent_sub, user, account):
+	analysis_start = time.perf_counter()
+
 	# Data points
 	username = str(user)
-	date_created = user.created
-	analysis_time = datetime.now()
-	total_comment_karma = user.comment_karma
-	total_post_karma = user.link_karma
-	total_karma = total_comment_karma + total_post_karma
-
-	comment_karma_counter = Counter()
-	post_karma_counter = Counter()
-	pos_comment_counter = Counter()
-	neg_comment_counter = Counter()
-	pos_post_counter = Counter()
-	neg_post_counter = Counter()
-	pos_QC_counter = Counter()
-	neg_QC_counter = Counter()
-
-	# Parse comments
-	for comment in user.comments.new(limit = None):
-		cmnt_sub = comment.subreddit
-		sub_name = str(cmnt_sub)
-		cmnt_score = comment.score
-		word_count = countWords(comment.body)
-		abbrev = None
-
-		if sub_name.upper() in parent_sub.all_subs:
-			abbrev = parent_sub.all_subs[sub_name.upper()]
-
-		if abbrev != None:
-			comment_karma_counter[abbrev] += cmnt_score
-			if cmnt_score > 0:
-				pos_comment_counter[abbrev] += 1
-			elif cmnt_score < 0:
-				neg_comment_counter[abbrev] += 1
-
-			if cmnt_score >= parent_sub.QC_config['pos_karma']:
-				if parent_sub.QC_config['word_count'] == None:
-					pos_QC_counter[abbrev] += 1
-				elif word_count >= parent_sub.QC_config['word_count']:
-					pos_QC_counter[abbrev] += 1
-			if cmnt_score <= parent_sub.QC_config['neg_karma']:
-				if parent_sub.QC_config['neg_words'] == None:
-					neg_QC_counter[abbrev] += 1
-				elif any(word in comment.body for word in parent_sub.QC_config['neg_words']):
-					neg_QC_counter[abbrev] += 1
-
-	# Parse posts
-	for post in user.submissions.new(limit = None):
-		post_sub = post.subreddit
-		sub_name = str(post_sub)
-		post_score = post.score
-		abbrev = None
-
-		if sub_name in parent_sub.A_subs:
-			abbrev = parent_sub.A_subs[sub_name.upper()]
-		elif sub_name in parent_sub.B_subs:
-			abbrev = parent_sub.B_subs[sub_name.upper()]
-
-		if abbrev != None:
-			post_karma_counter[abbrev] += cmnt_score
-
-			if post_score > 0:
-				pos_comment_counter[abbrev] += 1
-			elif post_score < 0:
-				neg_comment_counter[abbrev] += 1
-	# Return user info
-	return parent_sub.makeUser(user, username, date_created, analysis_time, total_comment_karma, total_post_karma, total_karma, comment_karma_counter, post_karma_counter, pos_comment_counter, neg_comment_counter, pos_post_counter, neg_post_counter, pos_QC_counter, neg_QC_counter)
+	date_created, total_comment_karma, total_post_karma = account
+	qc_profile = parent_sub.qc_profile
 
+	# Start from the shared totals, all items are read again if they have not been counted with this sub's QC settings or a sub was wiped
+	stored = parent_sub.history_db.get(username)
+	if stored == None:
+		history = {'comment_mark' : None, 'post_mark' : None, 'comments' : {}, 'posts' : {}, 'qc' : {}}
+	else:
+		history = stored[1]
+	shared_qc_profiles = parent_sub.shared_qc_profiles | set([qc_profile])
+	if qc_profile not in history['qc'] or 'stale' in history:
+		history = {'comment_mark' : None, 'post_mark' : None, 'comments' : {}, 'posts' : {}, 'qc' : dict((profile, {}) for profile in shared_qc_profiles)}
+	for profile in [profile for profile in history['qc'] if profile not in shared_qc_profiles]:
+		del history['qc'][profile]
+	history['account'] = [date_created, total_comment_karma, total_post_karma]
+	unsettled_totals = history.pop('unsettled', None)
+	if unsettled_totals != None:
+		addTotals(history, unsettled_totals, -1)
+	qc_counters = [(profile, getQCCounter(profile)) for profile in history['qc']]
+	aggregator = HistoryAggregator(qc_counters)
+	unsettled = HistoryAggregator(qc_counters)
+	settle_time = time.time() - parent_sub.main_config.get('score_settle', 48) * 3600
+
+	# Count comments newer than the mark
+	comment_mark = history['comment_mark']
+	for comment in throttled(user.comments.new(limit = None), api_bucket):
+		if comment_mark != None and (comment.fullname == comment_mark[0] or comment.created_utc < comment_mark[1]):
+			break
+		if comment.created_utc > settle_time:
+			unsettled.addComment(str(comment.subreddit), comment.score, comment.body)
+			continue
+		if history['comment_mark'] == comment_mark:
+			history['comment_mark'] = [comment.fullname, comment.created_utc]
+		aggregator.addComment(str(comment.subreddit), comment.score, comment.body)
+
+	# Count posts newer than the mark
+	post_mark = history['post_mark']
+	for post in throttled(user.submissions.new(limit = None), api_bucket):
+		if post_mark != None and (post.fullname == post_mark[0] or post.created_utc < post_mark[1]):
+			break
+		if post.created_utc > settle_time:
+			unsettled.addPost(str(post.subreddit), post.score)
+			continue
+		if history['post_mark'] == post_mark:
+			history['post_mark'] = [post.fullname, post.created_utc]
+		aggregator.addPost(str(post.subreddit), post.score)
+
+	aggregator.mergeInto(history)
+	if unsettled.comment_count + unsettled.post_count > 0:
+		unsettled_totals = {'comments' : {}, 'posts' : {}, 'qc' : dict((profile, {}) for profile in history['qc'])}
+		unsettled.mergeInto(unsettled_totals)
+		addTotals(history, unsettled_totals)
+		history['unsettled'] = unsettled_totals
+	parent_sub.history_db.save(username, history)
+	metrics.count('analyzeHistory.comments', aggregator.comment_count + unsettled.comment_count)
+	metrics.count('analyzeHistory.posts', aggregator.post_count + unsettled.post_count)
+	metrics.count('analyzeHistory.unsettled', unsettled.comment_count + unsettled.post_count)
+	metrics.record('analyzeHistory.qc_cpu', aggregator.qc_time + unsettled.qc_time)
+	metrics.record('analyzeHistory', time.perf_counter() - analysis_start)
+	user_info = parent_sub.projectHistory(username, history, datetime.now())
+	user_info.save()
+	return user_info
+
+# Analyze one user's history, returns the user, their info or None if they are not accessible, and whether the fetch failed
+# An error only fails this user, so the rest of the batch is still flaired
+def fetchUser(parent_sub, user):
+	try:
+		user, user_info = fetchHistory(parent_sub, user)
+	except Exception as error:
+		print ('\tAnalysis failed for user ' + str(user) + ': ' + repr(error))
+		metrics.count('fetchUser.errors')
+		return user, None, True
+	return user, user_info, False
+
+def fetchHistory(parent_sub, user):
+	# Users analyzed recently by any sub or worker are not fetched again
+	stored = parent_sub.history_db.get(str(user))
+	if stored != None and parent_sub.qc_profile in stored[1]['qc'] and 'account' in stored[1] and 'stale' not in stored[1] and datetime.now() - stored[0] < timedelta(minutes=parent_sub.main_config.get('history_reuse', 60)):
+		print ('\tUsing shared history for user: ' + str(user))
+		metrics.count('fetchUser.shared_history')
+		user_info = parent_sub.projectHistory(str(user), stored[1], datetime.now())
+		user_info.save()
+		return user, user_info
+
+	account = parent_sub.getAccount(user, api_bucket)
+	if account == None:
+		metrics.count('fetchUser.inaccessible')
+		return user, None
+	# Expired users loaded from the database are stored as usernames, and comment authors belong to the stream's Reddit instance
+	user = setUser(str(user))
+
+	print ('\tAnalyzing user: ' + str(user))
+	return user, analyzeHistory(parent_sub, user, account)
+
+# Fetch threads are kept between batches, so each keeps its own logged in Reddit instance
+fetch_pools = {}
+
+# Returns the pool of fetch threads for a number of workers, only called from the analysis thread
+def fetchPool(workers):
+	pool = fetch_pools.get(workers)
+	if pool == None:
+		pool = fetch_pools[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fetch')
+	return pool
 
 # Get users' history and process data based on info
+# Returns the users whose history could not be fetched, so they can stay queued
 def analyzeUsers(parent_sub, user_list):
 	current_time = datetime.now()
 
-	for user in user_list:
-		try:
-			user.fullname
-		except (prawcore.exceptions.NotFound, AttributeError):
+	# Fetch histories in parallel, results stay in the same order as user_list
+	pool = fetchPool(parent_sub.main_config.get('analysis_workers', 4))
+	results = list(pool.map(lambda user: fetchUser(parent_sub, user), user_list))
+
+	failed = []
+	for user, user_info, fetch_failed in results:
+		if fetch_failed:
+			failed.append(user)
+		if user_info == None:
 			continue
-			
 		username = str(user)
-		print ('\tAnalyzing user: ' + username)
-		user_info = analyzeHistory(parent_sub, user)
 
 		# Subreddit Progression
 		if parent_sub.main_config['sub_progression'] == True:
 			# Check info against each tier's rule
-			for tier, config in parent_sub.progression_config.items():
-				if tier.startswith('tier') and checkInfoTag(parent_sub, user_info, config):
-					flair_text = config['flair_text']
-					flair_css = config['flair_css']
-					permissions = config['permissions']
-
-					parent_sub.appendFlair(user, flair_text, flair_css)
-					if permissions == 'CUSTOM_FLAIR':
+			for tier_rule in parent_sub.progression_rules:
+				if tier_rule.check(user_info):
+					parent_sub.appendFlair(user, tier_rule.flair_text, tier_rule.flair_css)
+					if tier_rule.permissions == 'CUSTOM_FLAIR':
 						parent_sub.addWhitelist(username)
-					elif permissions == 'FLAIR_ICONS':
+					elif tier_rule.permissions == 'FLAIR_ICONS':
 						parent_sub.addImgFlair(username)
 					# Break on the first tier matched to avoid multiple tiers
 					break
@@ -262,171 +382,224 @@ def analyzeUsers(parent_sub, user_list):
 		# Subreddit Tags
 		if parent_sub.main_config['sub_tags'] == True:
 			# Check info against each tag's rule
-			for tag, config in parent_sub.subtag_config.items():
-				if tag.startswith('subtag'):
-					hold_subs = getSubTag(parent_sub, user_info, config)
-					pre_text = config['pre_text']
-
-					for sub in hold_subs:
-						post_text = ''
-						if config['show_value'] == True:
-							post_text += ': ' + str(user_info.info_dict[config['metric']][sub])
-						post_text += config['post_text']
-						parent_sub.appendFlair(user, (pre_text + sub + post_text), None)
+			for tag_rule in parent_sub.subtag_rules:
+				for sub in tag_rule.tags(user_info):
+					parent_sub.appendFlair(user, tag_rule.text(sub, user_info.metric(tag_rule.metric)[sub]), None)
 
 		# Account Age Tag
-		if parent_sub.main_config['accnt_age'] != False:
-			userCreated = user_info.date_created
-			tdelta = relativedelta.relativedelta(datetime.now(), datetime.fromtimestamp(user_info.date_created))
-			if tdelta.months <= parent_sub.main_config['accnt_age']:
-				#create flair with appropriate time breakdown
-				if tdelta.years < 1:
-					if tdelta.months < 1:
-						days = tdelta.days
-						flairText = str(days)
-						if days == 1:
-							parent_sub.appendFlair(username, flairText + ' day old', None)
-						else:
-							parent_sub.appendFlair(username, flairText + ' days old', None)
-					else:
-						months = tdelta.months
-						flairText = str(months)
-						if months == 1:
-							parent_sub.appendFlair(user, flairText + ' month old', None)
-						else:
-							parent_sub.appendFlair(user, flairText + ' months old', None)
+		if parent_sub.main_config['accnt_age'] not in (False, None):
+			age_text = accountAgeText(user_info.date_created, parent_sub.main_config['accnt_age'])
+			if age_text != None:
+				parent_sub.appendFlair(user, age_text, None)
 					
 	# Assign users' flair based on analysis
 	parent_sub.flairUsers()
-
-# Check for PMs that require automated actions
-def readPMs(sub_dict):
-	messages = reddit.inbox.unread()
-	for message in messages:
-		author = message.author
-		username = str(author)
-		# Command messages must have '!' in the start of their subject
-		message_sub = message.subject[1:]
-		if message_sub in sub_dict:
-			parent_sub = sub_dict[message_sub]
-			print('Message accepted: ' + message.body + '\tSubreddit: ' + message_sub)
-			message_words = message.body.split()
-
-			if message.body == "!wipe" and username in parent_sub.mods:
-				parent_sub.wipePM()
-				message.reply('The user database has been wiped successfully')
-				message.mark_read()
-				print ('Message resolved: User database wiped')
-
-			# Custom Flair
-			elif message_words[0] == '!flair':
-					if username in parent_sub.whitelist or username in parent_sub.mods:
-						new_flair = message.body[7:]
-						parent_sub.flairUser(author, new_flair, '')
-						message.reply('Your flair has been set! It should now read:\n\n' + new_flair)
-						message.mark_read()
-						print ('Message resolved successfully')
-					else:
-						message.reply('You are not on the list of approved users for custom flair. If you feel that this is a mistake, please contact /u/shimmyjimmy97 or message the moderators.')
-						message.mark_read()
-						print ('Message resolved without action: User not approved for custom flair')
-						
-			elif message_words[0] == '!css':
-					if username in parent_sub.whitelist or username in parent_sub.mods:
-						css = message.body[5:]
-						text = next(sub.sub_obj.flair(author))['flair_text']
-						parent_sub.flairUser(author, text, css)
-
-			# Target username must be the second word listed
-			else:
-				try:
-					target_username = message_words[1]
-				except IndexError:
-					message.reply('This command requires more than one argument. If you belive this message is in error, please contact /u/shimmyjimmy97')
-					message.mark_read()
-					continue
-				user = setUser(target_username)
-				if user == None:
-					message.reply("The user was not able to be accessed by InstaMod. This could be becasue they don't exist, are shadowbanned, or a server error. If you feel that this is a mistake, please contact /u/shimmyjimmy97.")
-					message.mark_read()
-					print ('Message resolved without action: Target user not accessible')
-				# Whitelist
-				elif message_words[0] == "!whitelist":
-					if str(user) not in parent_sub.whitelist:
-						parent_sub.addWhitelist(target_username)
-						message.reply('The user: ' + target_username + ' has been added to the whitelist and will no longer recieve new flair. They are also now eligible for custom flair. The user will be notified of their whitelisted status now.')
-						message.mark_read()
-						user.message('You have been granted permission to assign custom flair! A moderator of r/' + parent_sub.sub_name + ' has granted your account permission to assign custom flair. To choose your flair, send me (/u/InstaMod) a private message with the syntax:\n\nSubject:\n\n    !SubredditName\n\nBody:    !flair flair text here\n\nFor example, if you want your flair to say "Future Proves Past" then your PM should look like this:\n\n    !flair Future Proves Past\n\n If you have any questions, please send /u/shimmyjimmy97 a PM, or contact the moderators.')
-						print ('Message resolved successfully')
-					else:
-						message.reply('The user: ' + target_username + ' is already in the whitelist')
-						message.mark_read()
-						print ('Message resolved without action: User already in whitelist')
-				# Graylist/Greylist
-				elif message_words[0] == "!greylist" or message_words[0] == '!graylist':
-					if str(user) not in parent_sub.graylist:
-						parent_sub.addGraylist(target_username)
-						message.reply('The user: ' + target_username + ' has been added to the graylist and will no longer recieve new flair.')
-						message.mark_read()
-						print ('Message resolved successfully')
-					else:
-						message.reply('The user: ' + target_username + ' is already in the graylist')
-						message.mark_read()
-						print ('Message resolved without action: User already in graylist')
-
-# Compares link flair to sub lock config flairs
-def checkThreadLock(parent_sub, link_flair):
-	for lock in parent_sub.threadlock_config:
-		if lock.startswith('threadlock') and link_flair == parent_sub.threadlock_config[lock]['flair_ID']:
-			return lock
-	return None
-
-# Creates a list of target subreddits from the config file settings
-def getTargetSubs(parent_sub, target_subs):
-	sub_list = []
-	if target_subs == 'A_SUBS':
-		for sub in parent_sub.A_subs:
-			sub_list.append(parent_sub.A_subs[sub])
-	elif target_subs == 'B_SUBS':
-		for sub in parent_sub.B_subs:
-			sub_list.append(parent_sub.B_subs[sub])
-	elif target_subs == 'ALL_SUBS':
-		for sub in parent_sub.all_subs:
-			sub_list.append(parent_sub.all_subs[sub])
+	return failed
+
+# PM commands, each handler gets the sub named in the subject, the message, its author and the words of the body
+# Messages are marked read after the handler returns
+
+def wipeCommand(parent_sub, message, author, message_words):
+	if userKey(author) not in parent_sub.mods:
+		message.reply('The !wipe command is reserved for moderators.')
+		print ('Message resolved without action: User is not a moderator')
+		return
+	parent_sub.wipePM()
+	message.reply('The user database has been wiped successfully')
+	print ('Message resolved: User database wiped')
+
+# Custom Flair
+def flairCommand(parent_sub, message, author, message_words):
+	username = userKey(author)
+	if username in parent_sub.whitelist or username in parent_sub.mods:
+		new_flair = message.body[7:]
+		parent_sub.flairUser(author, new_flair, '')
+		message.reply('Your flair has been set! It should now read:\n\n' + new_flair)
+		print ('Message resolved successfully')
 	else:
-		for abbrev in target_subs:
-			if abbrev != None:
-				sub_list.append(abbrev)
-	return sub_list
-
-# Makes a comparison based on config rule settings
-def checkComparison(comparison, total_value, value):
-	if comparison == 'LESS_THAN':
-		if total_value < value:
-			return True
-		return False
-	elif comparison == 'GREATER_THAN':
-		if total_value > value:
-			return True
-		return False
-	elif comparison == 'EQUAL_TO':
-		if total_value == value:
-			return True
-		return False
-	elif comparison == 'NOT_EQUAL_TO':
-		if total_value != value:
-			return True
-		return False
-	elif comparison == 'GREATER_THAN_EQUAL_TO':
-		if total_value >= value:
-			return True
-		return False
-	elif comparison == 'LESS_THAN_EQUAL_TO':
-		if total_value <= value:
-			return True
-		return False
+		message.reply('You are not on the list of approved users for custom flair. If you feel that this is a mistake, please contact /u/shimmyjimmy97 or message the moderators.')
+		print ('Message resolved without action: User not approved for custom flair')
+
+def cssCommand(parent_sub, message, author, message_words):
+	username = userKey(author)
+	if username in parent_sub.whitelist or username in parent_sub.mods:
+		css = message.body[5:]
+		text = parent_sub.getFlair(author)[0]
+		parent_sub.flairUser(author, text, css)
+
+# Target username must be the second word listed, returns the target user or None after replying
+def getTargetUser(parent_sub, message, message_words):
+	if len(message_words) < 2:
+		message.reply('This command requires more than one argument. If you belive this message is in error, please contact /u/shimmyjimmy97')
+		return None
+	user = parent_sub.getRedditor(message_words[1])
+	if user == None:
+		message.reply("The user was not able to be accessed by InstaMod. This could be becasue they don't exist, are shadowbanned, or a server error. If you feel that this is a mistake, please contact /u/shimmyjimmy97.")
+		print ('Message resolved without action: Target user not accessible')
+	return user
+
+# Whitelist
+def whitelistCommand(parent_sub, message, author, message_words):
+	if userKey(author) not in parent_sub.mods:
+		message.reply('The !whitelist command is reserved for moderators.')
+		print ('Message resolved without action: User is not a moderator')
+		return
+	user = getTargetUser(parent_sub, message, message_words)
+	if user == None:
+		return
+	target_username = message_words[1]
+	if userKey(user) not in parent_sub.whitelist:
+		parent_sub.addWhitelist(target_username)
+		message.reply('The user: ' + target_username + ' has been added to the whitelist and will no longer recieve new flair. They are also now eligible for custom flair. The user will be notified of their whitelisted status now.')
+		user.message('You have been granted permission to assign custom flair! A moderator of r/' + parent_sub.sub_name + ' has granted your account permission to assign custom flair. To choose your flair, send me (/u/InstaMod) a private message with the syntax:\n\nSubject:\n\n    !SubredditName\n\nBody:    !flair flair text here\n\nFor example, if you want your flair to say "Future Proves Past" then your PM should look like this:\n\n    !flair Future Proves Past\n\n If you have any questions, please send /u/shimmyjimmy97 a PM, or contact the moderators.')
+		print ('Message resolved successfully')
+	else:
+		message.reply('The user: ' + target_username + ' is already in the whitelist')
+		print ('Message resolved without action: User already in whitelist')
+
+# Graylist/Greylist
+def graylistCommand(parent_sub, message, author, message_words):
+	if userKey(author) not in parent_sub.mods:
+		message.reply('The !graylist command is reserved for moderators.')
+		print ('Message resolved without action: User is not a moderator')
+		return
+	user = getTargetUser(parent_sub, message, message_words)
+	if user == None:
+		return
+	target_username = message_words[1]
+	if userKey(user) not in parent_sub.graylist:
+		parent_sub.addGraylist(target_username)
+		message.reply('The user: ' + target_username + ' has been added to the graylist and will no longer recieve new flair.')
+		print ('Message resolved successfully')
 	else:
+		message.reply('The user: ' + target_username + ' is already in the graylist')
+		print ('Message resolved without action: User already in graylist')
+
+# Re-tier the sub's stored users with the current rules, without fetching their history again
+def retierCommand(parent_sub, message, author, message_words):
+	if userKey(author) not in parent_sub.mods:
+		message.reply('The !retier command is reserved for moderators.')
+		print ('Message resolved without action: User is not a moderator')
+		return
+	if startRetier(parent_sub):
+		message.reply('Stored users are being re-tiered with the current settings. Only flair that changes will be updated.')
+		print ('Message resolved: Re-tier started')
+	else:
+		message.reply('Stored users are already being re-tiered.')
+		print ('Message resolved without action: Re-tier already running')
+
+pm_commands = {
+	'!wipe' : wipeCommand,
+	'!retier' : retierCommand,
+	'!flair' : flairCommand,
+	'!css' : cssCommand,
+	'!whitelist' : whitelistCommand,
+	'!greylist' : graylistCommand,
+	'!graylist' : graylistCommand
+}
+
+# Run the command in one message, messages for subs this process does not run are left unread
+def handleMessage(sub_dict, message):
+	# Command messages must have '!' in the start of their subject
+	message_sub = getattr(message, 'subject', '')[1:]
+	if message_sub not in sub_dict:
+		return
+	metrics.count('inbox.messages')
+	if not message_log.claim(message.fullname):
+		print('Message already handled: ' + message.fullname)
+		message.mark_read()
+		return
+
+	parent_sub = sub_dict[message_sub]
+	print('Message accepted: ' + message.body + '\tSubreddit: ' + message_sub)
+	message_words = message.body.split()
+	command = None
+	if len(message_words) > 0:
+		command = pm_commands.get(message_words[0])
+	command_start = time.time()
+	if command == None:
+		print ('Message resolved without action: Unknown command')
+	else:
+		# Commands change sub settings and lists, so they wait for the comment being handled
+		with stream_lock:
+			command(parent_sub, message, message.author, message_words)
+	metrics.record('inbox.command', time.time() - command_start)
+	message.mark_read()
+
+# Handle PMs as they arrive, alongside the comment stream
+def streamInbox(sub_dict):
+	while True:
+		try:
+			for message in getReddit().inbox.stream():
+				handleMessage(sub_dict, message)
+		except Exception as error:
+			print('\nInbox error: ' + repr(error) + '. Sleeping for 1 min')
+			time.sleep(60)
+
+# Re-tier a sub's stored users on their own thread so the stream and PMs are not held up
+# Returns False if the sub is already being re-tiered
+def startRetier(parent_sub):
+	if not parent_sub.retier_lock.acquire(blocking=False):
+		return False
+	def run():
+		try:
+			retierSub(parent_sub)
+		except Exception as error:
+			print('Re-tier failed for ' + parent_sub.sub_name + ': ' + repr(error))
+		finally:
+			parent_sub.retier_lock.release()
+	threading.Thread(target=run, name='retier', daemon=True).start()
+	return True
+
+# Handle a comment from the stream or backfill, comments already handled are skipped
+# A connection error is raised so the stream reconnects and handles the comment again, any other error only skips this comment
+def handleComment(sub_dict, comment):
+	if comment_log.seen(comment.fullname):
+		metrics.count('stream.duplicate')
 		return False
+	try:
+		with stream_lock:
+			sortComment(sub_dict, comment)
+	except connection_errors as error:
+		failures = comment_failures.get(comment.fullname, 0) + 1
+		if failures < comment_retries:
+			comment_failures[comment.fullname] = failures
+			raise
+		print('\nGiving up on comment ' + comment.fullname + ' after ' + str(failures) + ' attempts: ' + repr(error))
+		metrics.count('stream.comment_errors')
+	except Exception as error:
+		print('\nComment ' + comment.fullname + ' failed: ' + repr(error))
+		metrics.count('stream.comment_errors')
+	comment_failures.pop(comment.fullname, None)
+	comment_log.record(comment.fullname, str(comment.subreddit), comment.created_utc)
+	return True
+
+# Handle comments posted after each sub's checkpoint, read back oldest first from the subreddit's /comments listing
+# Reddit only lists about the newest 1000 comments, so older ones from a longer outage cannot be read back
+def backfillComments(sub_dict):
+	for parent_sub in sub_dict.values():
+		checkpoint = comment_log.checkpoint(parent_sub.sub_name)
+		if checkpoint == None:
+			continue
+		fullname, created = checkpoint
+		missed = []
+		for comment in throttled(parent_sub.subObj().comments(limit=1000), api_bucket):
+			if comment.fullname == fullname or comment.created_utc < created:
+				break
+			missed.append(comment)
+		handled = 0
+		for comment in reversed(missed):
+			if handleComment(sub_dict, comment):
+				handled += 1
+		metrics.count('stream.backfilled', handled)
+		print('Backfilled ' + str(handled) + ' comments in ' + parent_sub.sub_name)
+
+# Returns the first sub lock rule the user is caught by, or None
+def handelSubLock(parent_sub, user_info):
+	for lock_rule in parent_sub.sublock_rules:
+		if lock_rule.check(user_info):
+			return lock_rule
+	return None
 
 # Sort a Counter object from least common to most common
 def getLeastCommon(array, to_find=None):
@@ -435,135 +608,79 @@ def getLeastCommon(array, to_find=None):
         return sorted(counter.items(), key=itemgetter(1), reverse=False)
     return heapq.nsmallest(to_find, counter.items(), key=itemgetter(1))
 
-# Check comments in locked thread against the threads rule
-def handelThreadLock(parent_sub, lock_status, user_info):
-	lock_type = parent_sub.threadlock_config[lock_status]
-	metric = lock_type['metric']
-	target_subs = lock_type['target_subs']
-	comparison = lock_type['comparison']
-	value = lock_type['value']
-
-	user_data = user_info.info_dict[metric]
-	sub_list = getTargetSubs(parent_sub, target_subs)
-	total_value = 0
-
-	if 'total' in metric:
-		total_value = user_data
-	else:
-		for abbrev in sub_list:
-			total_value += user_data[abbrev]
-
-	return checkComparison(comparison, total_value, value)
-
-# Make Subreddit Tags based on users history
-def getSubTag(parent_sub, user_info, config):
-	metric = config['metric']
-	target_subs = config['target_subs']
-	sort = config['sort']
-	tag_cap = config['tag_cap']
-	comparison = config['comparison']
-	value = config['value']
-
-	# Makes a list of subs to total data from
-	sub_list = getTargetSubs(parent_sub, target_subs)
-	user_data = user_info.info_dict[metric]
-	hold_subs = []
-
-	if sort == 'MOST_COMMON':
-		tag_count = 0
-		for sub in user_data.most_common(5):
-			if tag_count >= tag_cap:
-				break
-			abbrev = sub[0]
-			data = sub[1]
-			if abbrev in sub_list:
-				if checkComparison(comparison, data, value):
-					hold_subs.append(abbrev)
-					tag_count += 1
-			else:
-				print('Sub not in sub list')
-		return hold_subs
-	if sort == 'LEAST_COMMON':
-		tag_count = 0
-		sorted_data = user_data.most_common()[:-tag_cap-1:-1]
-		for sub in sorted_data:
-			if tag_count >= tag_cap:
-				break
-			abbrev = sub[0]
-			data = sub[1]
-			if abbrev in sub_list:
-				if checkComparison(comparison, data, value):
-					hold_subs.append(sub[0])
-					tag_count += 1
-			else:
-				print('Sub not in list')
-		return hold_subs
-
-# Check user info agaisnt sub rule
-def checkInfoTag(parent_sub, user_info, config):
-	metric = config['metric']
-	if metric == 'ELSE':
-		return True
-	target_subs = config['target_subs']
-	comparison = config['comparison']
-	value = config['value']
-
-	# Makes a list of subs to total data from
-	sub_list = getTargetSubs(parent_sub, target_subs)
-
-	user_data = user_info.info_dict[metric]
-	total_value = 0
-	if 'total' in metric or metric == 'months old':
-		total_value = user_data
-	else:
-		for abbrev in sub_list:
-			total_value += user_data[abbrev]
-
-	return checkComparison(comparison, total_value, value)
-
-# Count the number of words in a comment
-def countWords(text):
-	word_count = 0
-	sentences = sent_tokenize(text)
-
-	for sentence in sentences:
-		words = sentence.split(' ')
-		for word in words:
-			if word.isalpha():
-				word_count += 1
-
-	return word_count
-
 # Main method for running the bot
-command = sys.argv[1]
+# Nothing runs when InstaMod is imported, so the replay benchmark can use its functions
+command = None
+if __name__ == '__main__':
+	command = sys.argv[1]
 
 if command == 'auto':
 
 	start_time = datetime.now()
+	startMetrics()
 	sub_dict = setSubs()
 	sub_str = "+".join(master_list)
 
+	# History analysis runs in the background, the stream only handles locks and ratelimits
+	analysis_queue = AnalysisQueue(analyzeUsers, releaseComments)
+	analysis_queue.start()
+	analysis_queue.restore(sub_dict)
+	# PM commands are handled on their own thread
+	message_log.removeBefore(datetime.now() - timedelta(days=30))
+	threading.Thread(target=streamInbox, args=(sub_dict,), name='inbox', daemon=True).start()
+	comment_latency = metrics.stats('sortComment')
+	# The supervisor stops workers with SIGTERM, which then shut down like Ctrl-C
+	signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+	# A dropped stream is reconnected after 5 seconds, doubling the wait after each failure up to 5 minutes
+	retry_wait = 5
 	while True:
 		try:
+			backfillComments(sub_dict)
 			all_subs = reddit.subreddit(sub_str)
 			for comment in all_subs.stream.comments(pause_after=1):
 				current_time = datetime.now()
+				retry_wait = 5
 				
 				if comment == None:
-					readPMs(sub_dict)
+					dumpMetrics()
+					# Save ratelimit counts while the stream is quiet
+					for parent_sub in sub_dict.values():
+						if len(parent_sub.ratelimiter.dirty) > 0:
+							parent_sub.saveRatelimit()
+					# Settings are reloaded when their wiki page has a new revision, and stored users are re-tiered if their flair rules changed
+					for parent_sub in sub_dict.values():
+						flair_settings = parent_sub.flairSettings()
+						if parent_sub.checkConfig() and parent_sub.flairSettings() != flair_settings and parent_sub.main_config.get('retier_on_change', True) == True:
+							startRetier(parent_sub)
 					
 					tdelta = current_time - start_time
 					hour_delta = tdelta.seconds / 3600.0
 					if hour_delta >= 1:
-						for name, obj in sub_dict.items():
-							obj.updateSub(name)
-							print('Updated Sub: ' + name)
-							start_time = datetime.now()
+						print('Comment latency: ' + str(comment_latency.summary()))
+						print('Analysis queue: ' + str(analysis_queue.stats()))
+						with stream_lock:
+							for name, obj in sub_dict.items():
+								print('Maintaining ' + name)
+								obj.maintainSub()
+								comment_log.trim(name, comment_window)
+								start_time = datetime.now()
 					continue
 				
 				else:
-					sortComment(sub_dict, comment)
-		except:
-			print('\nConnection Error. Sleeping for 5 min')
-			time.sleep(300)
-			continue
+					comment_start = time.time()
+					handleComment(sub_dict, comment)
+					comment_latency.record(time.time() - comment_start)
+		except KeyboardInterrupt:
+			print('\nStopping, saving ratelimit counts')
+			for parent_sub in sub_dict.values():
+				parent_sub.saveRatelimit()
+			dumpMetrics(force=True)
+			break
+		except Exception as error:
+			print('\nStream error: ' + repr(error) + '. Reconnecting in ' + str(retry_wait) + ' seconds')
+			metrics.count('stream.errors')
+			for parent_sub in sub_dict.values():
+				parent_sub.saveRatelimit()
+			time.sleep(retry_wait)
+			retry_wait = min(retry_wait * 2, 300)
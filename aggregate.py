@@ -0,0 +1,107 @@
+import time
+
+# Karma and positive and negative counts for one subreddit
+# qc holds a positive and a negative QC count for each QC profile, in the order the profiles were given
+class SubTotals:
+	__slots__ = ('karma', 'positive', 'negative', 'qc')
+
+	def __init__(totals, profile_count=0):
+		totals.karma = 0
+		totals.positive = 0
+		totals.negative = 0
+		totals.qc = [0] * (2 * profile_count)
+
+	def add(totals, score):
+		totals.karma += score
+		if score > 0:
+			totals.positive += 1
+		elif score < 0:
+			totals.negative += 1
+
+# Totals of a user's new comments and posts, counted in one pass and then added to their stored history
+# Only the subreddit, score and body of each item are read, so nothing keeps a praw object after it is counted
+class HistoryAggregator:
+	__slots__ = ('profiles', 'counters', 'comments', 'posts', 'names', 'comment_count', 'post_count', 'qc_time')
+
+	# qc_counters is a list of (QC profile, countQC function)
+	def __init__(aggregator, qc_counters):
+		aggregator.profiles = [profile for profile, countQC in qc_counters]
+		aggregator.counters = [countQC for profile, countQC in qc_counters]
+		aggregator.comments = {}
+		aggregator.posts = {}
+		aggregator.names = {}
+		aggregator.comment_count = 0
+		aggregator.post_count = 0
+		# CPU time spent on word counts and neg_words checks
+		aggregator.qc_time = 0.0
+
+	# Uppercase subreddit name, made once per subreddit instead of once per item
+	def subName(aggregator, subreddit):
+		name = aggregator.names.get(subreddit)
+		if name == None:
+			name = aggregator.names[subreddit] = subreddit.upper()
+		return name
+
+	def addComment(aggregator, subreddit, score, body):
+		aggregator.comment_count += 1
+		name = aggregator.subName(subreddit)
+		totals = aggregator.comments.get(name)
+		if totals == None:
+			totals = aggregator.comments[name] = SubTotals(len(aggregator.counters))
+		totals.add(score)
+
+		qc_start = time.thread_time()
+		qc = totals.qc
+		for index, countQC in enumerate(aggregator.counters):
+			pos_QC, neg_QC = countQC(score, body)
+			qc[2 * index] += pos_QC
+			qc[2 * index + 1] += neg_QC
+		aggregator.qc_time += time.thread_time() - qc_start
+
+	def addPost(aggregator, subreddit, score):
+		aggregator.post_count += 1
+		name = aggregator.subName(subreddit)
+		totals = aggregator.posts.get(name)
+		if totals == None:
+			totals = aggregator.posts[name] = SubTotals()
+		totals.add(score)
+
+	# Add the new totals to a stored history, QC counts are only stored for subreddits that have any
+	# The totals are dropped once added, so they are not held while the history is saved
+	def mergeInto(aggregator, history):
+		for name, totals in aggregator.comments.items():
+			stored = history['comments'].setdefault(name, [0, 0, 0])
+			stored[0] += totals.karma
+			stored[1] += totals.positive
+			stored[2] += totals.negative
+			for index, profile in enumerate(aggregator.profiles):
+				pos_QC = totals.qc[2 * index]
+				neg_QC = totals.qc[2 * index + 1]
+				if pos_QC or neg_QC:
+					sub_QC = history['qc'][profile].setdefault(name, [0, 0])
+					sub_QC[0] += pos_QC
+					sub_QC[1] += neg_QC
+		for name, totals in aggregator.posts.items():
+			stored = history['posts'].setdefault(name, [0, 0, 0])
+			stored[0] += totals.karma
+			stored[1] += totals.positive
+			stored[2] += totals.negative
+		aggregator.comments = {}
+		aggregator.posts = {}
+
+# Add totals kept in the same shape as a history to it, or take them away with sign -1
+# Entries left at zero are dropped, as if the items were never counted
+def addTotals(history, totals, sign=1):
+	addSection(history['comments'], totals['comments'], sign)
+	addSection(history['posts'], totals['posts'], sign)
+	for profile, qc_totals in totals['qc'].items():
+		if profile in history['qc']:
+			addSection(history['qc'][profile], qc_totals, sign)
+
+def addSection(stored_section, section, sign):
+	for name, values in section.items():
+		stored = stored_section.setdefault(name, [0] * len(values))
+		for index, value in enumerate(values):
+			stored[index] += sign * value
+		if not any(stored):
+			del stored_section[name]
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+# Offline benchmarks for InstaMod's hot spots
+# Usage: python benchmark.py [words] [negwords] [replay] [retier] [setting=value ...]
+# Settings are passed to the replay and retier benchmarks, eg comments=5000 users=1000 latency=0.05 rate_limit=600 recording=stream.json
+
+# Python imports
+import random
+import sys
+import time
+from ast import literal_eval
+
+# File system imports
+from qc import getWordCounter, getNegWordMatcher
+from replay import replay, replayRetier
+
+# Words and punctuation used to build synthetic comments
+vocab = ['the', 'a', 'bitcoin', 'Ethereum', 'moon', 'HODL', 'price', 'is', 'going', 'to', 'dump', 'pump', 'I', 'think', 'wallet', 'exchange', 'fees', 'lol', 'scam', 'great', 'project', 'team', "don't", 'buy', 'sell', '100x', '$5k', '2018', '10', 'ICO', 'whitepaper', 'blockchain', 'node', 'fork', 'u/someone', 'r/CryptoCurrency', 'https://example.com/page', 'über', 'café', 'e.g.', 'U.S.', 'J.', 'etc.', '(really', 'this)', '"quote"', "'ok'", '[1]']
+endings = ['.', '.', '!', '?', '', ',', '...', ':)', '."', '.)', '!)', '?"', ".'", '...)', '.]', ':']
+
+# Build a repeatable set of reddit-like comments with sentences, line breaks and links
+def makeCorpus(size=5000, seed=1):
+	rand = random.Random(seed)
+	corpus = []
+	for i in range(size):
+		sentences = []
+		for j in range(rand.randint(1, 8)):
+			words = [rand.choice(vocab) for k in range(rand.randint(2, 25))]
+			words[0] = words[0].capitalize()
+			sentences.append(' '.join(words) + rand.choice(endings))
+		text = ''
+		for sentence in sentences:
+			text += sentence + rand.choice([' ', ' ', ' ', '\n\n', '  '])
+		corpus.append(text.strip())
+	return corpus
+
+# Time a function over every comment in the corpus, returns the results and seconds taken
+def timeAll(function, corpus):
+	start = time.perf_counter()
+	results = [function(text) for text in corpus]
+	return results, time.perf_counter() - start
+
+# Compare the fast word counter with the NLTK counter it replaces
+def benchWords():
+	corpus = makeCorpus()
+	fast_counts, fast_time = timeAll(getWordCounter({'word_counter' : 'FAST'}), corpus)
+	print('FAST:  ' + str(round(fast_time * 1000, 1)) + ' ms for ' + str(len(corpus)) + ' comments')
+	try:
+		nltk_counts, nltk_time = timeAll(getWordCounter({'word_counter' : 'NLTK'}), corpus)
+	except (ImportError, LookupError) as error:
+		print('NLTK:  skipped, ' + type(error).__name__)
+		return
+	matching = sum(1 for fast, nltk in zip(fast_counts, nltk_counts) if fast == nltk)
+	print('NLTK:  ' + str(round(nltk_time * 1000, 1)) + ' ms for ' + str(len(corpus)) + ' comments')
+	print('Same count for ' + str(matching) + ' of ' + str(len(corpus)) + ' comments, ' + str(round(nltk_time / fast_time, 1)) + 'x faster')
+
+# Make a list of moderator style phrases, some of which appear in the corpus
+def makeNegWords(size=300, seed=2):
+	rand = random.Random(seed)
+	neg_words = ['scam', 'HODL', 'to the moon']
+	while len(neg_words) < size:
+		neg_words.append(''.join(rand.choice('abcdefghijklmnopqrstuvwxyz') for i in range(rand.randint(4, 12))))
+	return neg_words
+
+# Compare the compiled neg_words matcher with checking each phrase in turn
+# Runs once with phrases found in most comments and once with phrases found in none
+def benchNegWords():
+	corpus = makeCorpus()
+	for neg_words in (makeNegWords(), makeNegWords()[3:]):
+		loop_results, loop_time = timeAll(lambda text: any(word in text for word in neg_words), corpus)
+		print('Loop:   ' + str(round(loop_time * 1000, 1)) + ' ms for ' + str(len(corpus)) + ' comments and ' + str(len(neg_words)) + ' phrases, ' + str(sum(loop_results)) + ' matched')
+		for ignore_case, whole_word in ((False, False), (True, False), (False, True)):
+			QC_config = {'neg_words' : neg_words, 'neg_words_ignore_case' : ignore_case, 'neg_words_whole_word' : whole_word}
+			matcher = getNegWordMatcher(QC_config)
+			regex_results, regex_time = timeAll(matcher, corpus)
+			line = 'Regex:  ' + str(round(regex_time * 1000, 1)) + ' ms, ignore_case=' + str(ignore_case) + ' whole_word=' + str(whole_word)
+			if not ignore_case and not whole_word:
+				line += ', same result for ' + str(sum(1 for a, b in zip(loop_results, regex_results) if a == b)) + ' of ' + str(len(corpus))
+			print(line)
+
+def printResults(results):
+	for name, value in results.items():
+		if isinstance(value, float):
+			value = round(value, 2)
+		print(name + ': ' + str(value))
+
+# Replay a comment stream against fake Reddit objects and report throughput, latency, API use and memory
+def benchReplay(**settings):
+	printResults(replay(**settings))
+
+# Re-tier synthetic stored users with NumPy and report the time taken and flair sent
+def benchRetier(**settings):
+	printResults(replayRetier(**settings))
+
+benchmarks = {
+	'words' : benchWords,
+	'negwords' : benchNegWords,
+	'replay' : benchReplay,
+	'retier' : benchRetier
+}
+
+# Main method for running benchmarks
+if __name__ == '__main__':
+	names = [arg for arg in sys.argv[1:] if '=' not in arg] or list(benchmarks)
+	settings = {}
+	for arg in sys.argv[1:]:
+		if '=' in arg:
+			setting, value = arg.split('=', 1)
+			try:
+				settings[setting] = literal_eval(value)
+			except (ValueError, SyntaxError):
+				settings[setting] = value
+	for name in names:
+		print('== ' + name)
+		if name in ('replay', 'retier'):
+			benchmarks[name](**settings)
+		else:
+			benchmarks[name]()
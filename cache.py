@@ -0,0 +1,48 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import dateutil.parser
+
+# Bounded cache of analyzed User objects keyed by username
+# The least recently used user is dropped when the cache is full, and users expire with their flair
+class UserCache:
+	def __init__(cache, max_size, expiration_days):
+		cache.max_size = max_size
+		cache.expiration = timedelta(days=expiration_days)
+		cache.users = OrderedDict()
+		cache.lock = threading.Lock()
+
+	# Returns the cached User, or None if they are missing or expired
+	def get(cache, username):
+		with cache.lock:
+			entry = cache.users.get(username)
+			if entry == None:
+				return None
+			expires, user_info = entry
+			if datetime.now() >= expires:
+				del cache.users[username]
+				return None
+			cache.users.move_to_end(username)
+			return user_info
+
+	def put(cache, user_info):
+		analysis_time = user_info.analysis_time
+		if isinstance(analysis_time, str):
+			analysis_time = dateutil.parser.parse(analysis_time)
+		expires = analysis_time + cache.expiration
+		with cache.lock:
+			cache.users[user_info.username] = (expires, user_info)
+			cache.users.move_to_end(user_info.username)
+			while len(cache.users) > cache.max_size:
+				cache.users.popitem(last=False)
+
+	def remove(cache, username):
+		with cache.lock:
+			cache.users.pop(username, None)
+
+	def clear(cache):
+		with cache.lock:
+			cache.users.clear()
+
+	def __len__(cache):
+		return len(cache.users)
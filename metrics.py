@@ -0,0 +1,125 @@
+# Counters and timers for the bot's hot paths
+# Settings come from the environment:
+#	INSTAMOD_METRICS_PORT - serve Prometheus text on http://127.0.0.1:PORT/metrics and JSON on /metrics.json
+#	INSTAMOD_METRICS_FILE - write the JSON to this file every INSTAMOD_METRICS_INTERVAL seconds, 60 by default
+#	INSTAMOD_PROFILE - profile the comment stream with cProfile and write the stats to this file with each dump
+import cProfile
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pipeline import LatencyStats
+
+class Metrics:
+	def __init__(metrics):
+		metrics.counters = {}
+		metrics.timers = {}
+		metrics.lock = threading.Lock()
+		metrics.started = time.time()
+
+	def count(metrics, name, amount=1):
+		with metrics.lock:
+			metrics.counters[name] = metrics.counters.get(name, 0) + amount
+
+	# Latency figures for a timer, made the first time it is used
+	def stats(metrics, name):
+		with metrics.lock:
+			stats = metrics.timers.get(name)
+			if stats == None:
+				stats = metrics.timers[name] = LatencyStats()
+			return stats
+
+	def record(metrics, name, seconds):
+		metrics.stats(name).record(seconds)
+
+	# Times the stages of one call, each lap records the time since the last one as name.stage
+	def stages(metrics, name):
+		return Stopwatch(metrics, name)
+
+	def snapshot(metrics):
+		with metrics.lock:
+			counters = dict(metrics.counters)
+			timers = dict(metrics.timers)
+		return {'uptime' : time.time() - metrics.started, 'counters' : counters, 'timers' : dict((name, stats.summary()) for name, stats in timers.items())}
+
+	# Prometheus text format, timers are summaries with p50 and p99 quantiles
+	def prometheus(metrics):
+		snapshot = metrics.snapshot()
+		lines = ['# TYPE instamod_events_total counter']
+		for name, value in sorted(snapshot['counters'].items()):
+			lines.append('instamod_events_total{name="' + name + '"} ' + str(value))
+		lines.append('# TYPE instamod_seconds summary')
+		for name, summary in sorted(snapshot['timers'].items()):
+			lines.append('instamod_seconds{name="' + name + '",quantile="0.5"} ' + repr(summary['p50']))
+			lines.append('instamod_seconds{name="' + name + '",quantile="0.99"} ' + repr(summary['p99']))
+			lines.append('instamod_seconds_sum{name="' + name + '"} ' + repr(summary['mean'] * summary['count']))
+			lines.append('instamod_seconds_count{name="' + name + '"} ' + str(summary['count']))
+		return '\n'.join(lines) + '\n'
+
+class Stopwatch:
+	def __init__(watch, metrics, name):
+		watch.metrics = metrics
+		watch.name = name
+		watch.last = time.perf_counter()
+
+	def lap(watch, stage):
+		now = time.perf_counter()
+		watch.metrics.record(watch.name + '.' + stage, now - watch.last)
+		watch.last = now
+
+# Shared by every module, like the praw instance
+metrics = Metrics()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	def do_GET(handler):
+		if handler.path == '/metrics':
+			body = metrics.prometheus()
+			content_type = 'text/plain; version=0.0.4'
+		elif handler.path == '/metrics.json':
+			body = json.dumps(metrics.snapshot())
+			content_type = 'application/json'
+		else:
+			handler.send_error(404)
+			return
+		handler.send_response(200)
+		handler.send_header('Content-Type', content_type)
+		handler.end_headers()
+		handler.wfile.write(body.encode('utf-8'))
+
+	# Requests are not logged to the bot's output
+	def log_message(handler, format, *args):
+		pass
+
+profiler = None
+last_dump = 0.0
+
+# Start the metrics endpoint and profiler that the environment asks for
+def startMetrics():
+	global profiler
+	port = os.environ.get('INSTAMOD_METRICS_PORT')
+	if port != None:
+		server = HTTPServer(('127.0.0.1', int(port)), MetricsHandler)
+		threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+		print('Serving metrics on http://127.0.0.1:' + port + '/metrics')
+	if os.environ.get('INSTAMOD_PROFILE') != None:
+		profiler = cProfile.Profile()
+		profiler.enable()
+		print('Profiling the comment stream to ' + os.environ['INSTAMOD_PROFILE'])
+
+# Write the JSON metrics and profile if the dump interval has passed
+def dumpMetrics(force=False):
+	global last_dump
+	interval = float(os.environ.get('INSTAMOD_METRICS_INTERVAL', 60))
+	if not force and time.time() - last_dump < interval:
+		return
+	last_dump = time.time()
+	path = os.environ.get('INSTAMOD_METRICS_FILE')
+	if path != None:
+		with open(path + '.tmp', 'w') as metrics_file:
+			json.dump(metrics.snapshot(), metrics_file, indent=1)
+		os.replace(path + '.tmp', path)
+	# Writing the stats stops the profiler, so it is started again to keep adding to the same stats
+	if profiler != None:
+		profiler.dump_stats(os.environ['INSTAMOD_PROFILE'])
+		profiler.enable()
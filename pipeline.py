@@ -0,0 +1,146 @@
+import queue
+import threading
+import time
+from collections import deque
+
+# Running latency figures for one stage of comment handling
+class LatencyStats:
+	def __init__(stats, sample_size=1000):
+		stats.count = 0
+		stats.total = 0.0
+		stats.max = 0.0
+		stats.samples = deque(maxlen=sample_size)
+		stats.lock = threading.Lock()
+
+	def record(stats, seconds):
+		with stats.lock:
+			stats.count += 1
+			stats.total += seconds
+			stats.max = max(stats.max, seconds)
+			stats.samples.append(seconds)
+
+	# Percentile over the most recent samples
+	def percentile(stats, percent):
+		with stats.lock:
+			samples = sorted(stats.samples)
+		if len(samples) == 0:
+			return 0.0
+		return samples[min(len(samples) - 1, int(len(samples) * percent / 100.0))]
+
+	def summary(stats):
+		mean = 0.0
+		if stats.count > 0:
+			mean = stats.total / stats.count
+		return {'count' : stats.count, 'mean' : mean, 'p50' : stats.percentile(50), 'p99' : stats.percentile(99), 'max' : stats.max}
+
+# Users waiting for history analysis, drained by a background thread
+# The comment stream only adds users here, so it never waits on history fetches
+# handler(parent_sub, user_list) returns the users it could not analyze, which stay in the saved queue for the next restart
+# Items held with a waiting user are passed to release(parent_sub, items) once the user's batch is done
+class AnalysisQueue:
+	def __init__(jobs, handler, release=None, batch_size=100):
+		jobs.handler = handler
+		jobs.release = release
+		jobs.batch_size = batch_size
+		jobs.queue = queue.Queue()
+		jobs.pending = set()
+		jobs.held = {}
+		jobs.lock = threading.Lock()
+		jobs.wait_time = LatencyStats()
+		jobs.batch_time = LatencyStats()
+		jobs.thread = threading.Thread(target=jobs.run, name='analysis', daemon=True)
+
+	def start(jobs):
+		jobs.thread.start()
+
+	# Queue users for analysis, users already waiting in the same sub are skipped
+	# Queued users are saved in the sub's user store until they are analyzed, so a restart does not lose them
+	def put(jobs, parent_sub, user_list):
+		queued = []
+		for user in user_list:
+			job_key = (parent_sub.sub_name, str(user).lower())
+			with jobs.lock:
+				if job_key in jobs.pending:
+					continue
+				jobs.pending.add(job_key)
+			queued.append(user)
+		if len(queued) == 0:
+			return
+		parent_sub.user_db.saveQueued([str(user) for user in queued])
+		for user in queued:
+			jobs.queue.put((parent_sub, user, time.time()))
+
+	# Keep an item with a user's waiting job until the user has been analyzed
+	# Returns False if the user is not waiting, so the caller has to handle the item itself
+	def hold(jobs, parent_sub, user, item):
+		job_key = (parent_sub.sub_name, str(user).lower())
+		with jobs.lock:
+			if job_key not in jobs.pending:
+				return False
+			jobs.held.setdefault(job_key, []).append(item)
+		return True
+
+	# Block until every queued user has been handled
+	def join(jobs):
+		jobs.queue.join()
+
+	# Queue the users each sub had waiting when the bot last stopped
+	def restore(jobs, sub_dict):
+		for parent_sub in sub_dict.values():
+			usernames = parent_sub.user_db.loadQueued()
+			if len(usernames) > 0:
+				print('Restored ' + str(len(usernames)) + ' queued users for ' + parent_sub.sub_name)
+				jobs.put(parent_sub, usernames)
+
+	def depth(jobs):
+		return jobs.queue.qsize()
+
+	# Take the next job and any others already waiting, up to batch_size
+	def nextBatch(jobs):
+		batch = [jobs.queue.get()]
+		while len(batch) < jobs.batch_size:
+			try:
+				batch.append(jobs.queue.get_nowait())
+			except queue.Empty:
+				break
+		return batch
+
+	def run(jobs):
+		while True:
+			batch = jobs.nextBatch()
+			start = time.time()
+
+			# Group users by sub so each sub's flair is still set in one pass
+			by_sub = {}
+			for parent_sub, user, queued_time in batch:
+				jobs.wait_time.record(start - queued_time)
+				by_sub.setdefault(parent_sub, []).append(user)
+
+			for parent_sub, user_list in by_sub.items():
+				# Users are only taken off the saved queue once they are analyzed and flaired
+				done = []
+				try:
+					failed = set(str(user).lower() for user in jobs.handler(parent_sub, user_list))
+					done = [user for user in user_list if str(user).lower() not in failed]
+				except Exception as error:
+					print('Analysis failed for ' + parent_sub.sub_name + ': ' + repr(error))
+				finally:
+					parent_sub.user_db.removeQueued([str(user) for user in done])
+					# Failed users can be queued again the next time they comment
+					held = []
+					with jobs.lock:
+						for user in user_list:
+							job_key = (parent_sub.sub_name, str(user).lower())
+							jobs.pending.discard(job_key)
+							held.extend(jobs.held.pop(job_key, []))
+					if len(held) > 0 and jobs.release != None:
+						try:
+							jobs.release(parent_sub, held)
+						except Exception as error:
+							print('Releasing held items failed for ' + parent_sub.sub_name + ': ' + repr(error))
+			jobs.batch_time.record(time.time() - start)
+			for job in batch:
+				jobs.queue.task_done()
+
+	def stats(jobs):
+		return {'depth' : jobs.depth(), 'wait' : jobs.wait_time.summary(), 'batch' : jobs.batch_time.summary()}
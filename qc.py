@@ -0,0 +1,162 @@
+# Quality Comment helpers, selected from QC_CONFIG when a sub's settings are loaded
+import json
+import re
+
+# Closing quotes and brackets after a sentence's final '.', '?' or '!', which Punkt keeps with that sentence
+# Other punctuation there starts the next sentence, so the word after it is not split off
+sentence_closers = '"\')]}'
+# Characters Punkt splits off the start of a word
+word_openers = '("`{[:;&#*@)}]-,'
+number_pattern = re.compile(r'-?[.,]?\d[\d,.-]*')
+# Common abbreviations from NLTK's English Punkt model, lowercase without the final '.', which do not end a sentence
+abbreviations = frozenset(['e.g', 'i.e', 'etc', 'vs', 'u.s', 'u.k', 'mr', 'mrs', 'ms', 'dr', 'st', 'jr', 'sr', 'inc', 'ltd', 'co', 'corp'])
+
+# Count the alphabetic words in a comment without sentence tokenizing it
+# NLTK's counter splits each sentence on spaces, so only tokens holding a line break can differ and they are checked for a sentence break
+def countWordsFast(text):
+	word_count = 0
+	previous = ''
+	for word in text.rstrip().split(' '):
+		if word.isalpha():
+			word_count += 1
+		elif not word.isprintable():
+			if word.isspace():
+				continue
+			if startsSentence(word, previous):
+				word_count += 1
+		elif word == '':
+			continue
+		previous = word
+	return word_count
+
+# Whether a token holding line breaks ends in a word that NLTK splits off as the start of a sentence
+# previous is the token before it, since the break can also be in the whitespace between the two
+def startsSentence(word, previous):
+	parts = word.split()
+	if not parts[-1].isalpha() or word[-1].isspace():
+		return False
+	if len(parts) > 1:
+		return endsSentence(parts[-2], parts[-1])
+	if word[0].isspace() and previous != '':
+		return endsSentence(previous.split()[-1], parts[-1])
+	return False
+
+# Whether Punkt ends a sentence after part when the next part is a word
+def endsSentence(part, next_part):
+	stripped = part.rstrip(sentence_closers)
+	if stripped == '' or stripped[-1] not in '.?!':
+		return False
+	if stripped[-1] != '.':
+		return True
+	core = stripped[:-1]
+	# An ellipsis does not end a sentence
+	if core.endswith('.'):
+		return False
+	# Neither does an abbreviation, even with a closing quote or bracket after it
+	core = core.lstrip(word_openers)
+	if core.lower().split('-')[-1] in abbreviations:
+		return False
+	if stripped != part:
+		return True
+	# An initial does not end a sentence, and a number only does before a capital
+	if len(core) == 1 and core.isalpha():
+		return False
+	if number_pattern.fullmatch(core):
+		return next_part[0].isupper()
+	return True
+
+# Returns the word counter selected in QC_CONFIG, NLTK is only imported if a config asks for it
+def getWordCounter(QC_config):
+	word_counter = QC_config.get('word_counter', 'FAST')
+	if word_counter == 'FAST':
+		return countWordsFast
+	elif word_counter == 'NLTK':
+		from nltk.tokenize import sent_tokenize
+
+		# Count the number of words in each sentence found by NLTK
+		def countWordsNLTK(text):
+			word_count = 0
+			for sentence in sent_tokenize(text):
+				for word in sentence.split(' '):
+					if word.isalpha():
+						word_count += 1
+			return word_count
+
+		return countWordsNLTK
+	raise ValueError('Unknown word_counter in QC_CONFIG: ' + str(word_counter))
+
+# Build a regex matching any of the phrases, with shared prefixes merged so the regex engine does not try each phrase in turn
+def makeTriePattern(phrases):
+	trie = {}
+	for phrase in phrases:
+		node = trie
+		for char in phrase:
+			node = node.setdefault(char, {})
+		node[''] = True
+	return makeTrieBranch(trie)
+
+def makeTrieBranch(node):
+	branches = []
+	for char in sorted(key for key in node if key != ''):
+		branches.append(re.escape(char) + makeTrieBranch(node[char]))
+	if len(branches) == 0:
+		return ''
+	if len(branches) == 1 and '' not in node:
+		return branches[0]
+	pattern = '(?:' + '|'.join(branches) + ')'
+	# A phrase can also end at this point
+	if '' in node:
+		pattern += '?'
+	return pattern
+
+# Compile QC_CONFIG's neg_words into one regex, returns a function that checks a comment or None when neg_words is off
+# Options neg_words_ignore_case and neg_words_whole_word change how the phrases are matched
+def getNegWordMatcher(QC_config):
+	neg_words = QC_config['neg_words']
+	if neg_words == None:
+		return None
+	# An empty phrase is in every comment and an empty list matches none
+	if '' in neg_words or len(neg_words) == 0:
+		return lambda text: len(neg_words) > 0
+	ignore_case = QC_config.get('neg_words_ignore_case', False)
+	phrases = set(neg_words)
+	if ignore_case:
+		phrases = set(phrase.lower() for phrase in phrases)
+	pattern = makeTriePattern(phrases)
+	if QC_config.get('neg_words_whole_word', False):
+		pattern = r'(?<!\w)' + pattern + r'(?!\w)'
+	search = re.compile(pattern).search
+
+	# Lowercasing the comment once is faster than a case insensitive regex
+	if ignore_case:
+		return lambda text: search(text.lower()) != None
+	return lambda text: search(text) != None
+
+# Key for the QC settings that stored comment totals were counted with
+def getQCProfile(QC_config):
+	return json.dumps([QC_config['pos_karma'], QC_config['word_count'], QC_config['neg_karma'], QC_config['neg_words'], QC_config.get('neg_words_ignore_case', False), QC_config.get('neg_words_whole_word', False), QC_config.get('word_counter', 'FAST')])
+
+# Comment checks for each QC profile, built from the profile itself so any process can count QC for any sub's settings
+qc_counters = {}
+
+# Returns a function giving (positive QC, negative QC) for a comment's score and body
+def getQCCounter(qc_profile):
+	qc_counter = qc_counters.get(qc_profile)
+	if qc_counter != None:
+		return qc_counter
+	pos_karma, word_count, neg_karma, neg_words, ignore_case, whole_word, word_counter = json.loads(qc_profile)
+	QC_config = {'neg_words' : neg_words, 'neg_words_ignore_case' : ignore_case, 'neg_words_whole_word' : whole_word, 'word_counter' : word_counter}
+	countWords = getWordCounter(QC_config)
+	hasNegWord = getNegWordMatcher(QC_config)
+
+	def countQC(score, body):
+		pos_QC = 0
+		neg_QC = 0
+		if score >= pos_karma and (word_count == None or countWords(body) >= word_count):
+			pos_QC = 1
+		if score <= neg_karma and (hasNegWord == None or hasNegWord(body)):
+			neg_QC = 1
+		return pos_QC, neg_QC
+
+	qc_counters[qc_profile] = countQC
+	return countQC
@@ -0,0 +1,425 @@
+# coding: utf-8
+
+# Offline replay of a comment stream through handleComment and the analysis queue
+# Fake praw objects serve synthetic or recorded user histories, with simulated API latency and rate limits
+
+# Python imports
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from ast import literal_eval
+from datetime import datetime
+
+# Sample config shipped with the bot, used as the wiki page of the replayed sub
+fixture_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Sample Configuration Layout')
+
+# Returns the sample config as wiki page text, with the settings the sample predates filled in
+def makeFixtureConfig(sub_name):
+	with open(fixture_path) as fixture:
+		sub_config = literal_eval(fixture.read())
+	sub_config['SUB_CONFIG']['name'] = sub_name
+	sub_config['SUB_CONFIG']['ratelimit'] = True
+	sub_config['QC_CONFIG']['word_count'] = sub_config['QC_CONFIG'].pop('pos_words')
+	sub_config['RATELIMIT_CONFIG'] = {
+		'comments1' : {'metric' : 'positive comments',
+					'target_subs' : ('CM'),
+					'comparison' : 'LESS_THAN_EQUAL_TO',
+					'value' : 20,
+					'max' : 5,
+					'interval' : 24,
+					'action' : 'REMOVE'},
+		'remove_message' : None
+	}
+	return repr(sub_config)
+
+# Counts API calls by kind and applies the simulated latency and rate limit to each one
+class FakeAPI:
+	def __init__(api, latency=0.0, rate_limit=1000000, window=600):
+		api.latency = latency
+		api.rate_limit = rate_limit
+		api.window = window
+		api.window_start = time.time()
+		api.used = 0
+		api.calls = {}
+		api.lock = threading.Lock()
+
+	def call(api, kind):
+		with api.lock:
+			now = time.time()
+			if now - api.window_start >= api.window:
+				api.window_start = now
+				api.used = 0
+			api.used += 1
+			api.calls[kind] = api.calls.get(kind, 0) + 1
+		if api.latency > 0:
+			time.sleep(api.latency)
+
+	def total(api, kinds=None):
+		with api.lock:
+			return sum(count for kind, count in api.calls.items() if kinds == None or kind in kinds)
+
+	# Rate limit headers as praw exposes them through reddit.auth.limits
+	@property
+	def limits(api):
+		with api.lock:
+			return {'remaining' : max(api.rate_limit - api.used, 0), 'reset_timestamp' : api.window_start + api.window, 'used' : api.used}
+
+# A praw listing, one API call for each page of 100 items
+class FakeListing:
+	def __init__(listing, api, kind, items):
+		listing.api = api
+		listing.kind = kind
+		listing.items = items
+		listing.pages = 0
+
+	def new(listing, limit=None):
+		for count in range(0, max(len(listing.items), 1), 100):
+			listing.api.call(listing.kind)
+			listing.pages += 1
+			for item in listing.items[count:count + 100]:
+				yield item
+
+class FakeThing:
+	def __init__(thing, **attributes):
+		thing.__dict__.update(attributes)
+
+class FakeMod:
+	def __init__(mod, api):
+		mod.api = api
+
+	def remove(mod, spam=False):
+		mod.api.call('remove')
+
+# Like praw, each comment author and each reddit.redditor() is a new lazy object that loads the account the first time it is read
+class FakeRedditor:
+	def __init__(redditor, api, name, account, comments, submissions):
+		redditor.api = api
+		redditor.name = name
+		redditor.account = account
+		redditor.comments = comments
+		redditor.submissions = submissions
+		redditor.fetched = False
+
+	def __str__(redditor):
+		return redditor.name
+
+	# A new lazy object for the same account
+	def lazy(redditor):
+		return FakeRedditor(redditor.api, redditor.name, redditor.account, redditor.comments, redditor.submissions)
+
+	# Loading a redditor is one API call
+	def fetch(redditor):
+		if not redditor.fetched:
+			redditor.api.call('redditor')
+			redditor.fetched = True
+
+	@property
+	def fullname(redditor):
+		redditor.fetch()
+		return 't2_' + redditor.name
+
+	@property
+	def created(redditor):
+		redditor.fetch()
+		return redditor.account[0]
+
+	@property
+	def comment_karma(redditor):
+		redditor.fetch()
+		return redditor.account[1]
+
+	@property
+	def link_karma(redditor):
+		redditor.fetch()
+		return redditor.account[2]
+
+	def message(redditor, subject, body):
+		redditor.api.call('message')
+
+class FakeFlair:
+	def __init__(flair, api):
+		flair.api = api
+		flair.current = {}
+
+	def __call__(flair, limit=None):
+		items = [{'user' : username, 'flair_text' : text, 'flair_css_class' : css} for username, (text, css) in flair.current.items()]
+		for count, item in enumerate(items):
+			if count % 100 == 0:
+				flair.api.call('flair list')
+			yield item
+
+	def update(flair, flair_list):
+		results = []
+		for count, item in enumerate(flair_list):
+			if count % 100 == 0:
+				flair.api.call('flair update')
+			flair.current[item['user']] = (item['flair_text'], item['flair_css_class'])
+			results.append({'ok' : True})
+		return results
+
+	def set(flair, user, text, css):
+		flair.api.call('flair set')
+		flair.current[str(user)] = (text, css)
+
+	def delete(flair, user):
+		flair.api.call('flair delete')
+		flair.current.pop(str(user), None)
+
+class FakeWikiPage:
+	def __init__(page, api, content_md):
+		page.api = api
+		page.text = content_md
+		page.revision_id = 'replay1'
+
+	@property
+	def content_md(page):
+		page.api.call('wiki')
+		return page.text
+
+	def revisions(page, limit=None):
+		page.api.call('wiki revisions')
+		yield {'id' : page.revision_id}
+
+class FakeSubreddit:
+	def __init__(subreddit, api, name, config):
+		subreddit.display_name = name
+		subreddit.flair = FakeFlair(api)
+		subreddit.wiki = {'InstaModSettings' : FakeWikiPage(api, config)}
+
+	def __str__(subreddit):
+		return subreddit.display_name
+
+class FakeInbox:
+	def stream(inbox):
+		return iter(())
+
+# Stands in for praw.Reddit, serving the subs and users of a recording
+class FakeReddit:
+	def __init__(reddit, api, subs, users):
+		reddit.api = api
+		reddit.auth = api
+		reddit.inbox = FakeInbox()
+		reddit.subs = subs
+		reddit.users = users
+
+	def subreddit(reddit, name):
+		return reddit.subs[name]
+
+	def redditor(reddit, name):
+		return reddit.users[name.lower()].lazy()
+
+	# Comments made by ID are lazy in praw, so only acting on one is a request
+	def comment(reddit, id):
+		return FakeThing(fullname='t1_' + id, mod=FakeMod(reddit.api))
+
+# Synthetic recording: users with histories spread over the sample's subs, and a comment stream
+# A few users write most of the comments, like a real sub
+def makeSynthetic(sub_name, comment_count=2000, user_count=500, max_history=1000, seed=3):
+	from benchmark import makeCorpus
+	rand = random.Random(seed)
+	bodies = makeCorpus(size=500, seed=seed)
+	history_subs = [sub_name, 'CryptoCurrency', 'Bitcoin', 'ethtrader', 'Monero', 'AskReddit', 'pics', 'news']
+	now = time.time()
+	users = {}
+	for i in range(user_count):
+		comments = []
+		for j in range(int(rand.paretovariate(1.2) * 20) % max_history):
+			comments.append([rand.choice(history_subs), int(rand.gauss(4, 8)), rand.choice(bodies), now - j * 3600])
+		posts = []
+		for j in range(rand.randint(0, 20)):
+			posts.append([rand.choice(history_subs), int(rand.gauss(10, 20)), now - j * 7200])
+		users['user' + str(i)] = {'created' : now - rand.randint(1, 2000) * 86400, 'comment_karma' : rand.randint(-50, 50000), 'link_karma' : rand.randint(0, 20000), 'comments' : comments, 'posts' : posts}
+
+	usernames = list(users)
+	flairs = [None, None, None, None, 'lvl 1 Lock', 'lvl 2 Lock']
+	stream = []
+	for i in range(comment_count):
+		author = usernames[min(int(rand.paretovariate(1.0)) - 1, user_count - 1)] if rand.random() < 0.5 else rand.choice(usernames)
+		stream.append([author, rand.choice(flairs), rand.choice(bodies)])
+	return {'users' : users, 'stream' : stream}
+
+# Build the fake Reddit for a recording and the comments to replay
+def makeFakeReddit(recording, sub_name, api):
+	users = {}
+	for name, info in recording['users'].items():
+		comments = [FakeThing(fullname='t1_' + name + str(i), subreddit=subreddit, score=score, body=body, created_utc=created) for i, (subreddit, score, body, created) in enumerate(info['comments'])]
+		posts = [FakeThing(fullname='t3_' + name + str(i), subreddit=subreddit, score=score, created_utc=created) for i, (subreddit, score, created) in enumerate(info['posts'])]
+		users[name.lower()] = FakeRedditor(api, name, (info['created'], info['comment_karma'], info['link_karma']), FakeListing(api, 'comments', comments), FakeListing(api, 'submissions', posts))
+	subreddit = FakeSubreddit(api, sub_name, makeFixtureConfig(sub_name))
+	reddit = FakeReddit(api, {sub_name : subreddit}, users)
+
+	posts = {}
+	stream = []
+	start = time.time()
+	for i, (author, post_flair, body) in enumerate(recording['stream']):
+		post = posts.setdefault(post_flair, FakeThing(title='Replay post', link_flair_text=post_flair))
+		stream.append(FakeThing(fullname='t1_replay' + str(i), author=users[author.lower()].lazy(), submission=post, subreddit=subreddit, body=body, created_utc=start + i, mod=FakeMod(api)))
+	return reddit, stream
+
+# Peak memory allocated while analyzing each user's history on its own, in KB, for up to sample users
+# The fake listings already hold every item, so this is the memory of the analysis and not of the praw objects
+def historyMemory(InstaMod, parent_sub, reddit, sample=100):
+	peaks = []
+	tracemalloc.start()
+	try:
+		for redditor in list(reddit.users.values())[:sample]:
+			parent_sub.history_db.remove([redditor.name])
+			start = tracemalloc.get_traced_memory()[0]
+			tracemalloc.reset_peak()
+			InstaMod.analyzeHistory(parent_sub, redditor, redditor.account)
+			peaks.append((tracemalloc.get_traced_memory()[1] - start) / 1024.0)
+	finally:
+		tracemalloc.stop()
+	return peaks
+
+# The bot keeps its files in the working directory and logs in when imported, so each run gets an empty directory and fake credentials
+# Returns the directory to go back to and the one to delete
+def enterWorkDir(sub_name):
+	start_dir = os.getcwd()
+	work_dir = tempfile.mkdtemp(prefix='instamod-replay-')
+	os.chdir(work_dir)
+	os.mkdir(sub_name)
+	os.environ['INSTAMOD_SITE'] = 'DEFAULT'
+	for setting in ('praw_client_id', 'praw_client_secret', 'praw_user_agent'):
+		os.environ.setdefault(setting, 'replay')
+	sys.path.insert(0, os.path.dirname(fixture_path))
+	return start_dir, work_dir
+
+# Replay the stream through handleComment and wait for every queued user to be analyzed
+# recording is a JSON file in the format makeSynthetic returns, otherwise a synthetic recording is made
+def replay(comments=2000, users=500, latency=0.0, rate_limit=1000000, recording=None):
+	sub_name = 'CryptoMarkets'
+	if recording != None:
+		with open(recording) as recording_file:
+			recording = json.load(recording_file)
+	else:
+		recording = makeSynthetic(sub_name, comment_count=comments, user_count=users)
+
+	start_dir, work_dir = enterWorkDir(sub_name)
+	try:
+		import InstaMod
+		import sub
+		from pipeline import AnalysisQueue, LatencyStats
+		from throttle import TokenBucket
+		from metrics import metrics
+
+		api = FakeAPI(latency=latency, rate_limit=rate_limit)
+		reddit, stream = makeFakeReddit(recording, sub_name, api)
+		# Every thread's Reddit instance is the fake one
+		InstaMod.reddit = reddit
+		sub.newReddit = lambda: reddit
+		sub.reddit_threads = threading.local()
+		InstaMod.api_bucket = TokenBucket(reddit)
+
+		# Bot output is silenced so it does not time the terminal
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+		try:
+			sub_dict = {sub_name : sub.Subreddit(sub_name)}
+			InstaMod.analysis_queue = AnalysisQueue(InstaMod.analyzeUsers, InstaMod.releaseComments)
+			InstaMod.analysis_queue.start()
+			setup_calls = api.total()
+
+			comment_latency = LatencyStats(sample_size=len(stream))
+			start = time.perf_counter()
+			for comment in stream:
+				comment_start = time.perf_counter()
+				InstaMod.handleComment(sub_dict, comment)
+				comment_latency.record(time.perf_counter() - comment_start)
+			stream_time = time.perf_counter() - start
+
+			InstaMod.analysis_queue.join()
+			total_time = time.perf_counter() - start
+
+			# Counted before the memory pass, which analyzes users again
+			analyzed = sum(1 for redditor in reddit.users.values() if redditor.comments.pages > 0)
+			api_calls = api.total() - setup_calls
+			history_calls = api.total(('redditor', 'comments', 'submissions'))
+			calls_by_kind = dict(api.calls)
+			user_memory = historyMemory(InstaMod, sub_dict[sub_name], reddit)
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+	finally:
+		os.chdir(start_dir)
+		shutil.rmtree(work_dir, ignore_errors=True)
+
+	latency_summary = comment_latency.summary()
+	return {
+		'comments' : len(stream),
+		'comments per sec' : len(stream) / stream_time,
+		'p50 ms' : latency_summary['p50'] * 1000,
+		'p99 ms' : latency_summary['p99'] * 1000,
+		'analysis done sec' : total_time,
+		'users analyzed' : analyzed,
+		'API calls' : api_calls,
+		'API calls per analyzed user' : history_calls / max(analyzed, 1),
+		'API calls by kind' : calls_by_kind,
+		'mean ms by stage' : dict((name, round(summary['mean'] * 1000, 4)) for name, summary in sorted(metrics.snapshot()['timers'].items()) if name.startswith('sortComment.')),
+		'peak RSS MB' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+		'mean peak KB per user' : sum(user_memory) / max(len(user_memory), 1),
+		'max peak KB per user' : max(user_memory or [0])
+	}
+
+# Re-tier a sub with synthetic stored users, once with no flair set and once more with nothing changed
+# Users are written straight to the history and user databases, so no analysis runs first
+def replayRetier(users=100000, seed=3):
+	sub_name = 'CryptoMarkets'
+	rand = random.Random(seed)
+	start_dir, work_dir = enterWorkDir(sub_name)
+	try:
+		import sub
+		from retier import retierSub
+
+		api = FakeAPI()
+		reddit, stream = makeFakeReddit({'users' : {}, 'stream' : []}, sub_name, api)
+		sub.newReddit = lambda: reddit
+		sub.reddit_threads = threading.local()
+		stdout = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+		try:
+			parent_sub = sub.Subreddit(sub_name)
+			history_subs = list(parent_sub.all_subs)[:40] + ['ASKREDDIT', 'PICS', 'NEWS']
+			now = time.time()
+			rows = []
+			for i in range(users):
+				history = {'comment_mark' : None, 'post_mark' : None, 'comments' : {}, 'posts' : {}, 'qc' : {parent_sub.qc_profile : {}}}
+				for sub_name_upper in rand.sample(history_subs, rand.randint(1, 8)):
+					positive = int(rand.paretovariate(1.2) * 5)
+					negative = rand.randint(0, 5)
+					history['comments'][sub_name_upper] = [positive * 3 - negative, positive, negative]
+					history['qc'][parent_sub.qc_profile][sub_name_upper] = [positive // 2, rand.randint(0, negative)]
+				history['account'] = [now - rand.randint(1, 2000) * 86400, rand.randint(-50, 50000), rand.randint(0, 20000)]
+				rows.append(('user' + str(i), datetime.now().isoformat(), json.dumps(history)))
+			parent_sub.history_db.importRows(rows)
+			for username, analyzed, info in rows:
+				parent_sub.user_db.insert({'username' : username, 'analysis_time' : analyzed})
+
+			start = time.perf_counter()
+			first_sent = retierSub(parent_sub)
+			first_time = time.perf_counter() - start
+			start = time.perf_counter()
+			second_sent = retierSub(parent_sub)
+			second_time = time.perf_counter() - start
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+	finally:
+		os.chdir(start_dir)
+		shutil.rmtree(work_dir, ignore_errors=True)
+
+	return {
+		'users' : users,
+		'first re-tier sec' : first_time,
+		'flair sent' : first_sent,
+		'second re-tier sec' : second_time,
+		'flair sent again' : second_sent,
+		'flair update calls' : api.calls.get('flair update', 0)
+	}
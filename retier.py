@@ -0,0 +1,229 @@
+# Re-tier every stored user of a sub from the shared history after its flair rules change, without fetching anything from Reddit
+# Each counter metric is loaded as a NumPy array of users x abbreviations the first time a rule needs it,
+# so each tier and tag rule is checked for every user at once and only flair that changed is sent
+# NumPy is only imported when a re-tier runs, so the bot still runs without it
+import time
+from datetime import datetime
+from dateutil import relativedelta
+from metrics import metrics
+from rules import accountAgeText
+
+# Where each counter metric is kept in a history row, as the section and the index in its totals
+metric_sources = {
+	'comment karma' : ('comments', 0),
+	'positive comments' : ('comments', 1),
+	'negative comments' : ('comments', 2),
+	'post karma' : ('posts', 0),
+	'positive posts' : ('posts', 1),
+	'negative posts' : ('posts', 2),
+	'positive QC' : ('qc', 0),
+	'negative QC' : ('qc', 1)
+}
+
+# Totals of many users as a sub sees them, the batch version of User
+class UserMatrix:
+	def __init__(matrix, numpy, parent_sub, usernames, histories):
+		matrix.numpy = numpy
+		matrix.usernames = usernames
+		matrix.abbrevs = sorted(set(parent_sub.all_subs.values()))
+		columns = dict((abbrev, column) for column, abbrev in enumerate(matrix.abbrevs))
+		sub_columns = dict((sub_name, columns[abbrev]) for sub_name, abbrev in parent_sub.all_subs.items())
+		qc_profile = parent_sub.qc_profile
+
+		# Each section is kept as (rows, columns, totals) until a metric from it is needed
+		entries = {'comments' : ([], [], []), 'posts' : ([], [], []), 'qc' : ([], [], [])}
+		created = []
+		comment_karma = []
+		post_karma = []
+		for row, history in enumerate(histories):
+			date_created, total_comment_karma, total_post_karma = history['account']
+			created.append(date_created)
+			comment_karma.append(total_comment_karma)
+			post_karma.append(total_post_karma)
+			for section, section_totals in (('comments', history['comments']), ('posts', history['posts']), ('qc', history['qc'][qc_profile])):
+				rows, sub_cols, values = entries[section]
+				for sub_name, totals in section_totals.items():
+					column = sub_columns.get(sub_name)
+					if column != None:
+						rows.append(row)
+						sub_cols.append(column)
+						values.append(totals)
+
+		matrix.entries = {}
+		for section, (rows, sub_cols, values) in entries.items():
+			width = 2 if section == 'qc' else 3
+			matrix.entries[section] = (numpy.array(rows, dtype=numpy.intp), numpy.array(sub_cols, dtype=numpy.intp), numpy.array(values, dtype=numpy.int64).reshape(-1, width))
+		matrix.created = numpy.array(created, dtype=numpy.float64)
+		matrix.totals = {
+			'total comment karma' : numpy.array(comment_karma, dtype=numpy.int64),
+			'total post karma' : numpy.array(post_karma, dtype=numpy.int64)
+		}
+		matrix.totals['total karma'] = matrix.totals['total comment karma'] + matrix.totals['total post karma']
+		matrix.dense = {}
+		matrix.present = {}
+
+	def shape(matrix):
+		return (len(matrix.usernames), len(matrix.abbrevs))
+
+	# A counter metric as users x abbreviations, built the first time a rule uses it
+	def metric(matrix, name):
+		numpy = matrix.numpy
+		values = matrix.dense.get(name)
+		if values is None:
+			if name == 'net QC':
+				values = matrix.metric('positive QC') - matrix.metric('negative QC')
+			else:
+				section, index = metric_sources[name]
+				rows, sub_cols, totals = matrix.entries[section]
+				values = numpy.zeros(matrix.shape(), dtype=numpy.int64)
+				numpy.add.at(values, (rows, sub_cols), totals[:, index])
+			matrix.dense[name] = values
+		return values
+
+	# Users x abbreviations that have an entry in the metric's Counter, which sub tags sort and check
+	def hasEntry(matrix, name):
+		section = 'qc' if name == 'net QC' else metric_sources[name][0]
+		present = matrix.present.get(section)
+		if present is None:
+			rows, sub_cols, totals = matrix.entries[section]
+			present = matrix.numpy.zeros(matrix.shape(), dtype=bool)
+			present[rows, sub_cols] = True
+			matrix.present[section] = present
+		return present
+
+	# A metric that is one number for the whole account
+	def total(matrix, name):
+		values = matrix.totals.get(name)
+		if values is None and name == 'months old':
+			now = datetime.now()
+			values = matrix.totals[name] = matrix.numpy.array([relativedelta.relativedelta(now, datetime.fromtimestamp(created)).months for created in matrix.created.tolist()], dtype=matrix.numpy.int64)
+		return values
+
+	def targetMask(matrix, target_subs):
+		return matrix.numpy.array([abbrev in target_subs for abbrev in matrix.abbrevs], dtype=bool)
+
+	# Users that match a rule, as a boolean array
+	def matches(matrix, rule):
+		if rule.always:
+			return matrix.numpy.ones(len(matrix.usernames), dtype=bool)
+		if rule.is_total:
+			values = matrix.total(rule.metric)
+		else:
+			values = matrix.metric(rule.metric)[:, matrix.targetMask(rule.target_subs)].sum(axis=1)
+		return rule.compare(values, rule.value)
+
+	# Sub tags for every user, the batch version of SubTagRule.tags
+	# Returns the columns of each user's row in the rule's sort order, which of them are tags, and their values in that order
+	def tags(matrix, rule):
+		numpy = matrix.numpy
+		values = matrix.metric(rule.metric)
+		present = matrix.hasEntry(rule.metric)
+		# Abbreviations without an entry sort last, ties keep abbreviation order like SubTagRule.tags
+		if rule.sort == 'MOST_COMMON':
+			sort_key = numpy.where(present, -values, numpy.inf)
+			limit = 5
+		elif rule.sort == 'LEAST_COMMON':
+			sort_key = numpy.where(present, values, numpy.inf)
+			limit = rule.tag_cap
+		else:
+			sort_key = numpy.where(present, 0, numpy.inf)
+			limit = len(matrix.abbrevs)
+		order = numpy.argsort(sort_key, axis=1, kind='stable')
+		sorted_values = numpy.take_along_axis(values, order, axis=1)
+		tagged = numpy.take_along_axis(present, order, axis=1) & (numpy.arange(len(matrix.abbrevs)) < limit)
+		tagged &= matrix.targetMask(rule.target_subs)[order]
+		tagged &= rule.compare(sorted_values, rule.value)
+		tagged &= numpy.cumsum(tagged, axis=1) <= rule.tag_cap
+		return order, tagged, sorted_values
+
+# Re-tier a sub's stored users and send the flair that changed, returns the number of users whose flair changed
+# Whitelisted, graylisted and moderator accounts are skipped like they are in the stream, and so is flair a moderator set
+def retierSub(parent_sub):
+	try:
+		import numpy
+	except ImportError:
+		print('Re-tiering ' + parent_sub.sub_name + ' needs NumPy, install it with pip install numpy')
+		return None
+	start_time = time.time()
+	# The config can be swapped while this runs, so one set of rules is used throughout
+	main_config = parent_sub.main_config
+	progression_rules = parent_sub.progression_rules
+	subtag_rules = parent_sub.subtag_rules
+	qc_profile = parent_sub.qc_profile
+
+	bot_flair = set(username.lower() for username in parent_sub.user_db.botFlairUsers())
+	skipped = parent_sub.whitelist | parent_sub.graylist | parent_sub.mods
+	usernames = []
+	for username in parent_sub.user_db.usernames():
+		user_key = username.lower()
+		if user_key not in skipped and (user_key not in parent_sub.current_flair or user_key in bot_flair):
+			usernames.append(username)
+
+	# Users whose totals are only in rows from before history was shared are left for their next analysis,
+	# and so are users whose comments have not been counted with the sub's current QC settings yet
+	activity = parent_sub.history_db.getMany(usernames)
+	loaded = []
+	histories = []
+	qc_outdated = 0
+	for username in usernames:
+		history = activity.get(username.lower())
+		if history != None and 'account' in history:
+			if qc_profile not in history['qc']:
+				qc_outdated += 1
+				continue
+			loaded.append(username)
+			histories.append(history)
+	matrix = UserMatrix(numpy, parent_sub, loaded, histories)
+	load_time = time.time() - start_time
+
+	# Index of the first tier each user matches, -1 for none
+	tiers = numpy.full(len(loaded), -1)
+	if main_config['sub_progression'] == True:
+		for index, tier_rule in enumerate(progression_rules):
+			tiers[(tiers == -1) & matrix.matches(tier_rule)] = index
+	tag_results = []
+	if main_config['sub_tags'] == True:
+		for tag_rule in subtag_rules:
+			order, tagged, sorted_values = matrix.tags(tag_rule)
+			tag_results.append((tag_rule, order, tagged, sorted_values, tagged.any(axis=1).tolist()))
+	# Only accounts younger than a year can get an age tag
+	accnt_age = main_config['accnt_age']
+	now = datetime.now()
+	young = (matrix.created > now.timestamp() - 366 * 86400).tolist()
+
+	flair_list = []
+	for row, username in enumerate(loaded):
+		pieces = []
+		tier_rule = None
+		if tiers[row] >= 0:
+			tier_rule = progression_rules[tiers[row]]
+			pieces.append((tier_rule.flair_text, tier_rule.flair_css))
+		for tag_rule, order, tagged, sorted_values, has_tags in tag_results:
+			if has_tags[row]:
+				for column, value in zip(order[row][tagged[row]].tolist(), sorted_values[row][tagged[row]].tolist()):
+					pieces.append((tag_rule.text(matrix.abbrevs[column], value), None))
+		if accnt_age not in (False, None) and young[row]:
+			age_text = accountAgeText(matrix.created[row], accnt_age, now)
+			if age_text != None:
+				pieces.append((age_text, None))
+		# Like an analysis, a user who gets no flair keeps what they have
+		if len(pieces) == 0:
+			continue
+
+		flair_text = ' | '.join(text for text, css in pieces)
+		css = pieces[-1][1]
+		if (flair_text, css or None) != parent_sub.getFlair(username):
+			flair_list.append({'user' : username, 'flair_text' : flair_text, 'flair_css_class' : css or ''})
+		if tier_rule != None and tier_rule.permissions == 'CUSTOM_FLAIR':
+			parent_sub.addWhitelist(username)
+		elif tier_rule != None and tier_rule.permissions == 'FLAIR_ICONS' and username.lower() not in parent_sub.flair_img:
+			parent_sub.addImgFlair(username)
+	evaluate_time = time.time() - start_time - load_time
+
+	parent_sub.updateFlair(flair_list)
+	metrics.count('retier.users', len(loaded))
+	metrics.count('retier.changed', len(flair_list))
+	metrics.count('retier.qc_outdated', qc_outdated)
+	metrics.record('retier', time.time() - start_time)
+	print('Re-tiered ' + str(len(loaded)) + ' users in ' + parent_sub.sub_name + ', ' + str(len(flair_list)) + ' flair changed, ' + str(qc_outdated) + ' waiting to be analyzed with the current QC settings (load ' + str(round(load_time, 2)) + 's, rules ' + str(round(evaluate_time, 2)) + 's)')
+	return len(flair_list)
@@ -0,0 +1,180 @@
+# Rule settings from the wiki config, compiled once by updateSub so comments are checked with a few attribute lookups
+import operator
+from datetime import datetime
+from dateutil import relativedelta
+
+comparisons = {
+	'LESS_THAN' : operator.lt,
+	'GREATER_THAN' : operator.gt,
+	'EQUAL_TO' : operator.eq,
+	'NOT_EQUAL_TO' : operator.ne,
+	'GREATER_THAN_EQUAL_TO' : operator.ge,
+	'LESS_THAN_EQUAL_TO' : operator.le
+}
+
+# Metrics counted per subreddit abbreviation
+counter_metrics = ('comment karma', 'post karma', 'positive comments', 'negative comments', 'positive posts', 'negative posts', 'positive QC', 'negative QC', 'net QC')
+
+# Metrics that are a single number for the whole account and ignore target_subs
+total_metrics = ('total comment karma', 'total post karma', 'total karma', 'months old')
+
+actions = ('REMOVE', 'SPAM')
+sorts = ('MOST_COMMON', 'LEAST_COMMON', None)
+
+# Turn a target_subs setting into a set of abbreviations
+def getTargetSubs(parent_sub, target_subs, rule_name):
+	if target_subs == 'A_SUBS':
+		return frozenset(parent_sub.A_subs.values())
+	elif target_subs == 'B_SUBS':
+		return frozenset(parent_sub.B_subs.values())
+	elif target_subs == 'ALL_SUBS':
+		return frozenset(parent_sub.all_subs.values())
+	# ('CM') in the config is a single string, not a tuple
+	if isinstance(target_subs, str):
+		target_subs = (target_subs,)
+	known_abbrevs = set(parent_sub.all_subs.values())
+	known_abbrevs.add(parent_sub.sub_abbrev)
+	for abbrev in target_subs:
+		if abbrev != None and abbrev not in known_abbrevs:
+			raise ValueError(rule_name + ': ' + repr(abbrev) + ' is not an abbreviation in A_SUBS or B_SUBS')
+	return frozenset(abbrev for abbrev in target_subs if abbrev != None)
+
+# A metric, target subs, comparison and value from one config rule
+class Rule:
+	__slots__ = ('name', 'config', 'metric', 'target_subs', 'compare', 'value', 'is_total', 'always')
+
+	def __init__(rule, parent_sub, name, config):
+		rule.name = name
+		rule.config = config
+		rule.metric = config['metric']
+		rule.always = rule.metric == 'ELSE'
+		rule.is_total = rule.metric in total_metrics
+		rule.target_subs = frozenset()
+		rule.compare = None
+		rule.value = config.get('value')
+		if rule.always:
+			return
+
+		# SUBLOCK_CONFIG's parent_QC is the net QC from this subreddit only
+		target_subs = config.get('target_subs', parent_sub.sub_abbrev)
+		if rule.metric == 'parent_QC':
+			rule.metric = 'net QC'
+			target_subs = parent_sub.sub_abbrev
+
+		if rule.metric not in counter_metrics and not rule.is_total:
+			raise ValueError(name + ': unknown metric ' + repr(rule.metric))
+		if config.get('comparison') not in comparisons:
+			raise ValueError(name + ': unknown comparison ' + repr(config.get('comparison')))
+		if not isinstance(rule.value, (int, float)) or isinstance(rule.value, bool):
+			raise ValueError(name + ': value must be a number')
+		rule.compare = comparisons[config['comparison']]
+		if not rule.is_total:
+			rule.target_subs = getTargetSubs(parent_sub, target_subs, name)
+
+	# The user's metric totaled over the target subs
+	def total(rule, user_info):
+		if rule.is_total:
+			return user_info.metric(rule.metric)
+		return user_info.total(rule.metric, rule.target_subs)
+
+	def check(rule, user_info):
+		if rule.always:
+			return True
+		return rule.compare(rule.total(user_info), rule.value)
+
+# Subreddit progression tier
+class TierRule(Rule):
+	__slots__ = ('flair_text', 'flair_css', 'permissions')
+
+	def __init__(rule, parent_sub, name, config):
+		Rule.__init__(rule, parent_sub, name, config)
+		rule.flair_text = config['flair_text']
+		rule.flair_css = config['flair_css']
+		rule.permissions = config['permissions']
+
+# Subreddit tag, compared against each target sub on its own
+class SubTagRule(Rule):
+	__slots__ = ('sort', 'tag_cap', 'show_value', 'pre_text', 'post_text')
+
+	def __init__(rule, parent_sub, name, config):
+		Rule.__init__(rule, parent_sub, name, config)
+		if rule.always or rule.is_total:
+			raise ValueError(name + ': sub tags need a metric counted by subreddit')
+		rule.sort = config['sort']
+		if rule.sort not in sorts:
+			raise ValueError(name + ': unknown sort ' + repr(rule.sort))
+		rule.tag_cap = config['tag_cap']
+		rule.show_value = config.get('show_value', False)
+		rule.pre_text = config['pre_text']
+		rule.post_text = config['post_text']
+
+	# Returns the abbreviations the user is tagged with
+	# Ties are broken by abbreviation, so a batch re-tier picks the same tags as an analysis
+	def tags(rule, user_info):
+		user_data = user_info.metric(rule.metric)
+		if rule.sort == 'MOST_COMMON':
+			sorted_data = sorted(user_data.items(), key=lambda item: (-item[1], item[0]))[:5]
+		elif rule.sort == 'LEAST_COMMON':
+			sorted_data = sorted(user_data.items(), key=lambda item: (item[1], item[0]))[:rule.tag_cap]
+		else:
+			sorted_data = sorted(user_data.items())
+
+		hold_subs = []
+		for abbrev, data in sorted_data:
+			if len(hold_subs) >= rule.tag_cap:
+				break
+			if abbrev in rule.target_subs and rule.compare(data, rule.value):
+				hold_subs.append(abbrev)
+		return hold_subs
+
+	# Flair text for one tag
+	def text(rule, abbrev, value):
+		post_text = ''
+		if rule.show_value == True:
+			post_text += ': ' + str(value)
+		return rule.pre_text + abbrev + post_text + rule.post_text
+
+# Account age flair for accounts younger than a year whose months are at most accnt_age, or None
+def accountAgeText(date_created, accnt_age, now=None):
+	if now == None:
+		now = datetime.now()
+	tdelta = relativedelta.relativedelta(now, datetime.fromtimestamp(date_created))
+	if tdelta.months > accnt_age or tdelta.years >= 1:
+		return None
+	if tdelta.months < 1:
+		if tdelta.days == 1:
+			return '1 day old'
+		return str(tdelta.days) + ' days old'
+	if tdelta.months == 1:
+		return '1 month old'
+	return str(tdelta.months) + ' months old'
+
+# Thread lock, sub lock or ratelimit rule that removes comments
+class LockRule(Rule):
+	__slots__ = ('action', 'lock_ID', 'max', 'interval')
+
+	def __init__(rule, parent_sub, name, config):
+		Rule.__init__(rule, parent_sub, name, config)
+		rule.action = config['action']
+		if rule.action not in actions:
+			raise ValueError(name + ': unknown action ' + repr(rule.action))
+		rule.lock_ID = config.get('flair_ID', config.get('lock_ID'))
+		rule.max = config.get('max')
+		rule.interval = config.get('interval')
+
+# Comment ratelimit for users matching the rule
+class RatelimitRule(LockRule):
+	__slots__ = ()
+
+	def __init__(rule, parent_sub, name, config):
+		LockRule.__init__(rule, parent_sub, name, config)
+		if not isinstance(rule.max, int) or not isinstance(rule.interval, (int, float)):
+			raise ValueError(name + ': max and interval must be numbers')
+
+# Compile each rule in a config section whose name starts with prefix, keeping their order
+def compileRules(parent_sub, section_name, section, prefix, rule_class):
+	rules = []
+	for name, config in section.items():
+		if name.startswith(prefix):
+			rules.append(rule_class(parent_sub, section_name + ' ' + name, config))
+	return rules
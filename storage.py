@@ -0,0 +1,355 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from tinydb import TinyDB
+
+# Long-lived user info database for one subreddit
+# Rows are keyed by username, so lookups hit the primary key index instead of scanning every user
+class UserStore:
+	def __init__(store, sub_name):
+		store.sub_name = sub_name
+		store.path = sub_name + '/userInfo.db'
+		store.lock = threading.Lock()
+		store.conn = sqlite3.connect(store.path, check_same_thread=False)
+		with store.lock, store.conn:
+			# Queued users and ratelimit counts are written from the comment stream, so commits skip the sync to disk
+			store.conn.execute('PRAGMA journal_mode=WAL')
+			store.conn.execute('PRAGMA synchronous=NORMAL')
+			store.conn.execute('CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, analysis_time TEXT, info TEXT)')
+			store.conn.execute('CREATE INDEX IF NOT EXISTS users_analysis_time ON users (analysis_time)')
+			store.conn.execute('CREATE TABLE IF NOT EXISTS flair (user_key TEXT PRIMARY KEY, username TEXT, flair_text TEXT, css TEXT, set_by_bot INTEGER)')
+			store.conn.execute('CREATE TABLE IF NOT EXISTS ratelimit (user_key TEXT PRIMARY KEY, last_seen REAL, windows TEXT)')
+			store.conn.execute('CREATE INDEX IF NOT EXISTS ratelimit_last_seen ON ratelimit (last_seen)')
+			store.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+			store.conn.execute('CREATE TABLE IF NOT EXISTS queue (user_key TEXT PRIMARY KEY, username TEXT, queued REAL)')
+		store.migrate()
+
+	# One-time import of the old TinyDB user info file
+	def migrate(store):
+		legacy_path = store.sub_name + '/userInfo.json'
+		if store.getMeta('migrated') != None or not os.path.exists(legacy_path):
+			return
+		legacy_rows = TinyDB(legacy_path).all()
+		with store.lock, store.conn:
+			store.conn.executemany('INSERT OR IGNORE INTO users VALUES (?, ?, ?)', [(row['username'], row['analysis_time'], json.dumps(dict(row))) for row in legacy_rows])
+			store.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('migrated', legacy_path))
+		print('\tMigrated ' + str(len(legacy_rows)) + ' users from ' + legacy_path)
+
+	def getMeta(store, key):
+		with store.lock:
+			row = store.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+		if row == None:
+			return None
+		return row[0]
+
+	# Returns a user's stored info as a dict, or None if they have not been analyzed
+	def get(store, username):
+		with store.lock:
+			row = store.conn.execute('SELECT info FROM users WHERE username = ?', (username,)).fetchone()
+		if row == None:
+			return None
+		return json.loads(row[0])
+
+	# Insert a user's info, replacing any existing row for them
+	def insert(store, info):
+		with store.lock, store.conn:
+			store.conn.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?)', (info['username'], info['analysis_time'], json.dumps(info)))
+
+	def remove(store, username):
+		with store.lock, store.conn:
+			store.conn.execute('DELETE FROM users WHERE username = ?', (username,))
+
+	# Delete every user analyzed before the cutoff in one write, returns the number removed
+	def removeBefore(store, cutoff):
+		with store.lock, store.conn:
+			return store.conn.execute('DELETE FROM users WHERE analysis_time < ?', (cutoff.isoformat(),)).rowcount
+
+	# Deletes every stored user
+	def purge(store):
+		with store.lock, store.conn:
+			store.conn.execute('DELETE FROM users')
+
+	# Iterate over all stored users' info
+	def rows(store):
+		with store.lock:
+			all_rows = store.conn.execute('SELECT info FROM users').fetchall()
+		for row in all_rows:
+			yield json.loads(row[0])
+
+	# History rows from before history was shared between subs, the table is dropped once they are read
+	def takeHistory(store):
+		with store.lock, store.conn:
+			if store.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history'").fetchone() == None:
+				return []
+			rows = store.conn.execute('SELECT username, updated, info FROM history').fetchall()
+			store.conn.execute('DROP TABLE history')
+		return rows
+
+	# Local copy of each user's flair, returns {lowercase username : (flair text, css)}
+	def loadFlair(store):
+		with store.lock:
+			rows = store.conn.execute('SELECT user_key, flair_text, css FROM flair').fetchall()
+		return dict((row[0], (row[1], row[2])) for row in rows)
+
+	# Save flair for a list of (username, flair text, css, set by bot) in one write
+	def saveFlair(store, flair_list):
+		with store.lock, store.conn:
+			store.conn.executemany('INSERT OR REPLACE INTO flair VALUES (?, ?, ?, ?, ?)', [(username.lower(), username, flair_text, css, int(set_by_bot)) for username, flair_text, css, set_by_bot in flair_list])
+
+	def removeFlair(store, username):
+		with store.lock, store.conn:
+			store.conn.execute('DELETE FROM flair WHERE user_key = ?', (username.lower(),))
+
+	# Replace the local flair copy with the subreddit's flair list
+	# Flair the bot set is still marked as the bot's if the text has not changed since
+	def replaceFlair(store, flair_list):
+		with store.lock, store.conn:
+			bot_flair = dict(store.conn.execute('SELECT user_key, flair_text FROM flair WHERE set_by_bot = 1').fetchall())
+			store.conn.execute('DELETE FROM flair')
+			store.conn.executemany('INSERT OR REPLACE INTO flair VALUES (?, ?, ?, ?, ?)', [(username.lower(), username, flair_text, css, int(bot_flair.get(username.lower()) == flair_text)) for username, flair_text, css in flair_list])
+			store.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('flair_reconciled', datetime.now().isoformat()))
+
+	# Usernames whose current flair was set by the bot's analysis
+	def botFlairUsers(store):
+		with store.lock:
+			return [row[0] for row in store.conn.execute('SELECT username FROM flair WHERE set_by_bot = 1')]
+
+	# Saved comment ratelimit windows as (user key, last comment time, windows)
+	def loadRatelimit(store):
+		with store.lock:
+			rows = store.conn.execute('SELECT user_key, last_seen, windows FROM ratelimit').fetchall()
+		return [(row[0], row[1], json.loads(row[2])) for row in rows]
+
+	# Save changed ratelimit windows and delete users who have not commented since cutoff
+	def saveRatelimit(store, rows, cutoff):
+		with store.lock, store.conn:
+			store.conn.executemany('INSERT OR REPLACE INTO ratelimit VALUES (?, ?, ?)', [(user_key, last_seen, json.dumps(windows)) for user_key, last_seen, windows in rows])
+			store.conn.execute('DELETE FROM ratelimit WHERE last_seen < ?', (cutoff,))
+
+	# Users waiting for analysis, kept so a restart analyzes them instead of losing them
+	def saveQueued(store, usernames):
+		with store.lock, store.conn:
+			store.conn.executemany('INSERT OR IGNORE INTO queue VALUES (?, ?, ?)', [(username.lower(), username, time.time()) for username in usernames])
+
+	def removeQueued(store, usernames):
+		with store.lock, store.conn:
+			store.conn.executemany('DELETE FROM queue WHERE user_key = ?', [(username.lower(),) for username in usernames])
+
+	# Queued usernames in the order they were queued
+	def loadQueued(store):
+		with store.lock:
+			return [row[0] for row in store.conn.execute('SELECT username FROM queue ORDER BY queued')]
+
+	def usernames(store):
+		with store.lock:
+			return [row[0] for row in store.conn.execute('SELECT username FROM users')]
+
+	def __contains__(store, username):
+		with store.lock:
+			row = store.conn.execute('SELECT 1 FROM users WHERE username = ?', (username,)).fetchone()
+		return row != None
+
+	def __len__(store):
+		with store.lock:
+			return store.conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+# Split a history row from before QC counts were kept by profile
+# Comment totals were [karma, positive, negative, positive QC, negative QC] counted with the row's qc_profile
+def convertHistory(history):
+	if 'qc_profile' not in history:
+		return history
+	qc_counts = {}
+	for sub_name, totals in history['comments'].items():
+		qc_counts[sub_name] = totals[3:5]
+		history['comments'][sub_name] = totals[0:3]
+	# Those profiles did not include the word counter, which was always 'FAST'
+	qc_profile = json.loads(history.pop('qc_profile'))
+	if len(qc_profile) == 6:
+		qc_profile.append('FAST')
+	history['qc'] = {json.dumps(qc_profile) : qc_counts}
+	return history
+
+# Raw activity from each user's last analysis, shared by every sub and every worker process
+# Rows hold per subreddit karma and counts, and QC counts for each set of QC settings they were counted with
+# Each sub totals a row by its own abbreviations and QC settings, so a user is fetched once for all subs
+# The database uses write-ahead logging so worker processes can read while another one writes
+class HistoryStore:
+	def __init__(store, path):
+		store.path = path
+		folder = os.path.dirname(path)
+		if folder != '':
+			os.makedirs(folder, exist_ok=True)
+		store.lock = threading.Lock()
+		store.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+		with store.lock, store.conn:
+			store.conn.execute('PRAGMA journal_mode=WAL')
+			store.conn.execute('PRAGMA synchronous=NORMAL')
+			store.conn.execute('CREATE TABLE IF NOT EXISTS activity (user_key TEXT PRIMARY KEY, updated TEXT, info TEXT)')
+			store.conn.execute('CREATE INDEX IF NOT EXISTS activity_updated ON activity (updated)')
+			store.conn.execute('CREATE TABLE IF NOT EXISTS retention (sub_name TEXT PRIMARY KEY, days REAL, updated REAL)')
+			store.conn.execute('CREATE TABLE IF NOT EXISTS qc_profiles (sub_name TEXT PRIMARY KEY, qc_profile TEXT, updated REAL)')
+			# Rows keyed by QC profile are converted once, the newest row for each user is kept
+			if store.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history'").fetchone() != None:
+				rows = store.conn.execute('SELECT user_key, updated, info FROM history ORDER BY updated').fetchall()
+				store.conn.executemany('INSERT OR REPLACE INTO activity VALUES (?, ?, ?)', [(user_key, updated, json.dumps(convertHistory(json.loads(info)))) for user_key, updated, info in rows])
+				store.conn.execute('DROP TABLE history')
+
+	# Returns the time the activity was saved and the activity, or None
+	def get(store, username):
+		with store.lock:
+			row = store.conn.execute('SELECT updated, info FROM activity WHERE user_key = ?', (username.lower(),)).fetchone()
+		if row == None:
+			return None
+		return datetime.fromisoformat(row[0]), json.loads(row[1])
+
+	# Returns {lowercase username : activity} for the users that have a row, read 500 users at a time
+	def getMany(store, usernames):
+		user_keys = [username.lower() for username in usernames]
+		activity = {}
+		for start in range(0, len(user_keys), 500):
+			chunk = user_keys[start:start + 500]
+			with store.lock:
+				rows = store.conn.execute('SELECT user_key, info FROM activity WHERE user_key IN (' + ','.join('?' * len(chunk)) + ')', chunk).fetchall()
+			for user_key, info in rows:
+				activity[user_key] = json.loads(info)
+		return activity
+
+	def save(store, username, history):
+		with store.lock, store.conn:
+			store.conn.execute('INSERT OR REPLACE INTO activity VALUES (?, ?, ?)', (username.lower(), datetime.now().isoformat(), json.dumps(history)))
+
+	# Add rows from a sub's own history table, rows already shared are kept
+	def importRows(store, rows):
+		with store.lock, store.conn:
+			store.conn.executemany('INSERT OR IGNORE INTO activity VALUES (?, ?, ?)', [(username.lower(), updated, json.dumps(convertHistory(json.loads(info)))) for username, updated, info in rows])
+
+	def remove(store, usernames):
+		with store.lock, store.conn:
+			store.conn.executemany('DELETE FROM activity WHERE user_key = ?', [(username.lower(),) for username in usernames])
+
+	# Mark users' activity to be read again from the start on their next analysis, every sub keeps using it until then
+	def markStale(store, usernames):
+		activity = store.getMany(usernames)
+		for history in activity.values():
+			history['stale'] = True
+		with store.lock, store.conn:
+			store.conn.executemany('UPDATE activity SET info = ? WHERE user_key = ?', [(json.dumps(history), user_key) for user_key, history in activity.items()])
+		return len(activity)
+
+	# Record the days of history a sub needs kept, returns the most days any sub that checked in over the last week needs
+	# Subs in other worker processes total their users from the same rows, so one sub's shorter retention must not remove them
+	def keepFor(store, sub_name, days):
+		now = time.time()
+		with store.lock, store.conn:
+			store.conn.execute('INSERT OR REPLACE INTO retention VALUES (?, ?, ?)', (sub_name, days, now))
+			return store.conn.execute('SELECT MAX(days) FROM retention WHERE updated > ?', (now - 7 * 86400,)).fetchone()[0]
+
+	# Record the QC settings a sub counts with, returns the QC settings of every sub that checked in over the last week
+	# Rows are counted for all of them at once, so subs in different worker processes do not drop each other's QC counts
+	def useProfile(store, sub_name, qc_profile):
+		now = time.time()
+		with store.lock, store.conn:
+			store.conn.execute('INSERT OR REPLACE INTO qc_profiles VALUES (?, ?, ?)', (sub_name, qc_profile, now))
+			return set(row[0] for row in store.conn.execute('SELECT DISTINCT qc_profile FROM qc_profiles WHERE updated > ?', (now - 7 * 86400,)))
+
+	def removeBefore(store, cutoff):
+		with store.lock, store.conn:
+			return store.conn.execute('DELETE FROM activity WHERE updated < ?', (cutoff.isoformat(),)).rowcount
+
+# Reddit account details shared by every sub and worker process, so an account is looked up once for all of them
+# Inaccessible accounts (deleted, suspended or shadowbanned) are kept as well, so they are not looked up again on every comment
+class AccountStore:
+	def __init__(store, path):
+		folder = os.path.dirname(path)
+		if folder != '':
+			os.makedirs(folder, exist_ok=True)
+		store.lock = threading.Lock()
+		store.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+		with store.lock, store.conn:
+			store.conn.execute('PRAGMA journal_mode=WAL')
+			store.conn.execute('PRAGMA synchronous=NORMAL')
+			# created is NULL for an inaccessible account
+			store.conn.execute('CREATE TABLE IF NOT EXISTS accounts (user_key TEXT PRIMARY KEY, checked REAL, created REAL, comment_karma INTEGER, link_karma INTEGER)')
+			store.conn.execute('CREATE INDEX IF NOT EXISTS accounts_checked ON accounts (checked)')
+
+	# Returns the time the account was looked up and (created, comment karma, link karma), or None for an inaccessible account
+	# Returns None if the account has not been looked up
+	def get(store, username):
+		with store.lock:
+			row = store.conn.execute('SELECT checked, created, comment_karma, link_karma FROM accounts WHERE user_key = ?', (username.lower(),)).fetchone()
+		if row == None:
+			return None
+		if row[1] == None:
+			return row[0], None
+		return row[0], (row[1], row[2], row[3])
+
+	# Save an account's details, or None for an inaccessible account
+	def save(store, username, account):
+		if account == None:
+			account = (None, None, None)
+		with store.lock, store.conn:
+			store.conn.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?, ?)', (username.lower(), time.time()) + tuple(account))
+
+	def removeBefore(store, cutoff):
+		with store.lock, store.conn:
+			return store.conn.execute('DELETE FROM accounts WHERE checked < ?', (cutoff,)).rowcount
+
+# Fullnames of PM commands that have been handled, shared by every worker process
+# A message is claimed before its command runs, so a crash before it is marked read never runs the command twice
+class MessageLog:
+	def __init__(log, path):
+		folder = os.path.dirname(path)
+		if folder != '':
+			os.makedirs(folder, exist_ok=True)
+		log.lock = threading.Lock()
+		log.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+		with log.lock, log.conn:
+			log.conn.execute('PRAGMA journal_mode=WAL')
+			log.conn.execute('CREATE TABLE IF NOT EXISTS handled (fullname TEXT PRIMARY KEY, handled TEXT)')
+			log.conn.execute('CREATE INDEX IF NOT EXISTS handled_time ON handled (handled)')
+
+	# Returns True if the message had not been claimed yet
+	def claim(log, fullname):
+		with log.lock, log.conn:
+			return log.conn.execute('INSERT OR IGNORE INTO handled VALUES (?, ?)', (fullname, datetime.now().isoformat())).rowcount == 1
+
+	def removeBefore(log, cutoff):
+		with log.lock, log.conn:
+			return log.conn.execute('DELETE FROM handled WHERE handled < ?', (cutoff.isoformat(),)).rowcount
+
+# Comments the stream has handled, kept for a window so comments seen again after a reconnect are skipped
+# The newest comment handled in each sub is its checkpoint, comments posted after it are read back on startup
+class CommentLog:
+	def __init__(log, path):
+		folder = os.path.dirname(path)
+		if folder != '':
+			os.makedirs(folder, exist_ok=True)
+		log.lock = threading.Lock()
+		log.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+		with log.lock, log.conn:
+			log.conn.execute('PRAGMA journal_mode=WAL')
+			log.conn.execute('PRAGMA synchronous=NORMAL')
+			log.conn.execute('CREATE TABLE IF NOT EXISTS handled (fullname TEXT PRIMARY KEY, sub_name TEXT, created REAL)')
+			log.conn.execute('CREATE INDEX IF NOT EXISTS handled_sub_created ON handled (sub_name, created)')
+
+	def seen(log, fullname):
+		with log.lock:
+			return log.conn.execute('SELECT 1 FROM handled WHERE fullname = ?', (fullname,)).fetchone() != None
+
+	# Record a comment once it has been handled
+	def record(log, fullname, sub_name, created):
+		with log.lock, log.conn:
+			log.conn.execute('INSERT OR IGNORE INTO handled VALUES (?, ?, ?)', (fullname, sub_name, created))
+
+	# Returns the fullname and creation time of the newest comment handled in the sub, or None
+	def checkpoint(log, sub_name):
+		with log.lock:
+			return log.conn.execute('SELECT fullname, created FROM handled WHERE sub_name = ? ORDER BY created DESC LIMIT 1', (sub_name,)).fetchone()
+
+	# Forget comments older than window seconds before the sub's checkpoint, the checkpoint itself is always kept
+	def trim(log, sub_name, window):
+		with log.lock, log.conn:
+			return log.conn.execute('DELETE FROM handled WHERE sub_name = ? AND created < (SELECT MAX(created) FROM handled WHERE sub_name = ?) - ?', (sub_name, sub_name, window)).rowcount
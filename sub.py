@@ -1,29 +1,68 @@
 import praw
 import prawcore
 import json
-from datetime import datetime, date
+import os
+import threading
+import time
+from datetime import datetime, date, timedelta
 from dateutil import relativedelta
 import dateutil.parser
 from tinydb import TinyDB, Query
 from collections import Counter
-from user import User
+from user import User, user_counters
+from storage import UserStore, HistoryStore, AccountStore
+from cache import UserCache
+from throttle import CommentLimiter
+from metrics import metrics
+from qc import getQCProfile, getQCCounter
+from rules import TierRule, SubTagRule, LockRule, RatelimitRule, compileRules
 from ast import literal_eval
+from types import SimpleNamespace
 
 #save current time
 current_time = datetime.now()
 
-#start instance of Reddit
-reddit = praw.Reddit('InstaMod')
+#start an instance of Reddit for each thread, praw.Reddit and its session are not safe to share between threads
+reddit_site = os.environ.get('INSTAMOD_SITE', 'InstaMod')
+reddit_threads = threading.local()
+
+# Returns this thread's Reddit instance, made the first time the thread asks for one
+# Requests from every instance still share one rate limit through the TokenBucket
+def getReddit():
+	reddit = getattr(reddit_threads, 'reddit', None)
+	if reddit == None:
+		reddit = reddit_threads.reddit = newReddit()
+	return reddit
+
+def newReddit():
+	return praw.Reddit(reddit_site)
+
+# Per subreddit totals shared by every sub and worker process, so a user active in several subs is fetched once
+history_db = HistoryStore('shared/history.db')
+
+# Account details and inaccessible accounts, shared by every sub and worker process
+account_db = AccountStore('shared/accounts.db')
 
 #initialize sub specific global variables
 find_stuff = Query()
 
 def setUser(username):
 	try:
-		return reddit.redditor(username)
+		return getReddit().redditor(username)
 	except (prawcore.exceptions.NotFound, AttributeError):
 		return None
 
+# Returns every username stored in a TinyDB user list
+def readUsernames(path):
+	return [row['username'] for row in TinyDB(path).all()]
+
+# Canonical form of a username used for membership checks
+def userKey(user):
+	return str(user).lower()
+
+# Columns of rows from before history was shared, in the order of user_counters
+legacy_columns = ('comment_karma_counter', 'post_karma_counter', 'pos_comment_counter', 'neg_comment_counter', 'pos_post_counter', 'neg_post_counter', 'pos_QC_counter', 'neg_QC_counter')
+
 def json_serial(obj):
     if isinstance(obj, (datetime, date)):
         return obj.isoformat()
@@ -32,40 +71,135 @@ def json_serial(obj):
 # Subreddit objectclass Subreddit:
 class Subreddit:
 	def __init__(sub, sub_name):
+		sub.user_db = UserStore(sub_name)
+		sub.history_db = history_db
+		sub.account_db = account_db
+		# Move this sub's history rows from before history was shared
+		sub.history_db.importRows(sub.user_db.takeHistory())
+		# Filled by the analysis thread, so it is not reset by updateSub
+		sub.users_and_flair = {}
+		# Local copy of current flair by lowercase username, reconciled with the flair list by updateSub
+		sub.current_flair = sub.user_db.loadFlair()
+		sub.flair_lock = threading.Lock()
+		# Flair set while a reconcile reads the flair list, or None when no reconcile is running
+		sub.reconcile_changes = None
+		# Held while the flair list is reconciled, so only one reconcile runs at a time
+		sub.reconcile_lock = threading.Lock()
+		# Held while the sub's stored users are re-tiered, so only one re-tier runs at a time
+		sub.retier_lock = threading.Lock()
+		# Comment counts for ratelimit rules, saved so a restart does not reset them
+		sub.ratelimiter = CommentLimiter()
+		sub.ratelimit_saved = time.time()
 		sub.updateSub(sub_name)
-		sub.start_interval = datetime.now()
+		sub.ratelimiter.load(sub.user_db.loadRatelimit())
 	
-	# Checks if the ratelimit dict needs to be cleared
-	def checkInterval(sub):
-		tdelta = datetime.now() - sub.time_created
-		hour_delta = tdelta.seconds / 3600.0
-		if hour_delta >= sub.ratelimit_config['comments']['interval']:
-			sub.ratelimit.clear()
-			sub.start_interval = datetime.now()
-			print('Ratelimit interval updated')
+	# Count a comment for the ratelimit rules, changed counts are saved at most once a minute
+	def recordComment(sub, username):
+		now = time.time()
+		sub.ratelimiter.record(userKey(username), now)
+		if now - sub.ratelimit_saved >= 60:
+			sub.saveRatelimit()
+
+	def saveRatelimit(sub):
+		sub.ratelimit_saved = time.time()
+		sub.user_db.saveRatelimit(sub.ratelimiter.changes(), sub.ratelimit_saved - sub.ratelimiter.idleTime())
+
+	# Replace the local flair copy with one pass over the subreddit flair list
+	# The list is read without holding flair_lock, flair the bot sets meanwhile is kept over what the list showed
+	def reconcileFlair(sub):
+		with sub.flair_lock:
+			sub.reconcile_changes = {}
+		flair_list = []
+		try:
+			for flair in sub.subObj().flair(limit=None):
+				flair_list.append((str(flair['user']), flair['flair_text'], flair['flair_css_class'] or None))
+		finally:
+			with sub.flair_lock:
+				changes = sub.reconcile_changes
+				sub.reconcile_changes = None
+		with sub.flair_lock:
+			sub.user_db.replaceFlair([flair for flair in flair_list if flair[0].lower() not in changes])
+			sub.user_db.saveFlair([flair for flair in changes.values() if flair != None])
+			sub.current_flair = sub.user_db.loadFlair()
+		print ('\tReconciled flair for ' + str(len(flair_list)) + ' users, ' + str(len(changes)) + ' changed during the pass')
+
+	# Reconcile on its own thread, paging the flair list of a large sub would hold up the stream
+	# Returns False if the sub's flair is already being reconciled
+	def startReconcile(sub):
+		if not sub.reconcile_lock.acquire(blocking=False):
+			return False
+		def run():
+			try:
+				sub.reconcileFlair()
+			except Exception as error:
+				print('Flair reconcile failed for ' + sub.sub_name + ': ' + repr(error))
+			finally:
+				sub.reconcile_lock.release()
+		threading.Thread(target=run, name='reconcile', daemon=True).start()
+		return True
+
+	# Returns a user's flair text and CSS class from the local flair copy
+	def getFlair(sub, user):
+		return sub.current_flair.get(userKey(user), (None, None))
+
+	# Record flair that was set as a list of (username, flair text, css, set by bot)
+	def rememberFlair(sub, flair_list):
+		flair_list = [(str(username), flair_text, css or None, set_by_bot) for username, flair_text, css, set_by_bot in flair_list]
+		with sub.flair_lock:
+			sub.user_db.saveFlair(flair_list)
+			for flair in flair_list:
+				sub.current_flair[userKey(flair[0])] = (flair[1], flair[2])
+				if sub.reconcile_changes != None:
+					sub.reconcile_changes[userKey(flair[0])] = flair
+
+	def forgetFlair(sub, username):
+		with sub.flair_lock:
+			sub.user_db.removeFlair(str(username))
+			sub.current_flair.pop(userKey(username), None)
+			if sub.reconcile_changes != None:
+				sub.reconcile_changes[userKey(username)] = None
 
 	# Flair all users in users_and_flair
+	# Only changed flair is sent, in bulk requests of up to 100 users
 	def flairUsers(sub):
-		sub_obj = sub.sub_obj
+		flair_start = time.time()
 		print ('Users and corresponding flair:')
+		flair_list = []
 		for username in sub.users_and_flair:
-			user = setUser(username)
 			new_flair = sub.users_and_flair[username]['text']
 			css = sub.users_and_flair[username]['css']
-			old_flair = next(sub.sub_obj.flair(user))['flair_text']
-			
-			if new_flair != old_flair:
-				sub_obj.flair.set(user, new_flair, css)
+			old_flair = sub.getFlair(username)
+
+			if (new_flair, css or None) != old_flair:
+				flair_list.append({'user' : username, 'flair_text' : new_flair, 'flair_css_class' : css or ''})
 				print ('\t' + username + ': ' + new_flair)
 			else:
 				print('\t' + username + ': Flair is unchanged')
+				metrics.count('flairUsers.unchanged')
 		sub.users_and_flair.clear()
+		sub.updateFlair(flair_list)
+		metrics.record('flairUsers', time.time() - flair_start)
+
+	# Send flair from the bot as {'user', 'flair_text', 'flair_css_class'} dicts in bulk requests of up to 100 users
+	def updateFlair(sub, flair_list):
+		if len(flair_list) == 0:
+			return
+		results = sub.subObj().flair.update(flair_list)
+		flair_set = []
+		for flair, result in zip(flair_list, results):
+			if result.get('ok', True):
+				flair_set.append((flair['user'], flair['flair_text'], flair['flair_css_class'], True))
+			else:
+				print ('\tFailed to flair ' + flair['user'] + ': ' + str(result.get('errors')))
+		sub.rememberFlair(flair_set)
+		metrics.count('flairUsers.written', len(flair_set))
+		metrics.count('flairUsers.failed', len(flair_list) - len(flair_set))
 
 	# Flair one user from users_and_flair
 	def flairUser(sub, user, flair_text, css):
-		sub_obj = sub.sub_obj
-		sub_obj.flair.set(user, flair_text, css)
-		print('Flaired user: ' + str(user) + '\tFlair: ' + flair_text + '\tCSS:' + css)
+		sub.subObj().flair.set(user, flair_text, css)
+		sub.rememberFlair([(user, flair_text, css, False)])
+		print('Flaired user: ' + str(user) + '\tFlair: ' + flair_text + '\tCSS:' + str(css))
 
 	# Concatonate flair with existing
 	def appendFlair(sub, user, new_flair, css):
@@ -80,20 +214,21 @@ class Subreddit:
 
 	# Add user to sub whitelist
 	def addWhitelist(sub, username):
-		user = setUser(username)
+		user = sub.getRedditor(username)
 		if user != None:
 			whitelistDB = TinyDB(sub.sub_name + '/whitelist.json')
 			whitelistDB.insert({'username' : username})
-			sub.whitelist.append(username)
+			sub.whitelist.add(userKey(username))
 			user.message('You have been granted custom flair permissions on /r/' + sub.sub_name, 'Your contributions to the community have granted you access to custom flair options. In order to apply your desired flair, please click on [this preformatted link.](https://www.reddit.com/message/compose?to=InstaMod&subject=!' + sub.sub_name + '&message=!flair+REPLACE+THIS+WITH+DESIRED+FLAIR+TEXT)\n\nThis link will likely not work on mobile. For assistance, please PM /u/shimmyjimmy97')
-			sub.sub_obj.flair.delete(username)
+			sub.subObj().flair.delete(username)
+			sub.forgetFlair(username)
 			print (username + ' added to whitelist and notified')
 
 	# Add user to sub graylist
 	def addGraylist(sub, username):
 		graylistDB = TinyDB(sub.sub_name + '/graylist.json')
 		graylistDB.insert({'username' : username})
-		sub.graylist.append(username)
+		sub.graylist.add(userKey(username))
 		print (username + ' added to graylist')
 
 	# Add a user to the expired list and database
@@ -101,161 +236,315 @@ class Subreddit:
 		username = str(user)
 		expiredDB = TinyDB(sub.sub_name + '/expired.json')
 		expiredDB.insert({'username' : username})
-		sub.expired_users.append(user)
+		sub.expired_users[userKey(user)] = user
 		print ('User: ' + username + ' added to expired list')
 
 	# Add an image flair option to the image flair list
 	def addImgFlair(sub, username):
 		flair_imgDB = TinyDB(sub.sub_name + '/flair_img.json')
 		flair_imgDB.insert({'username' : username})
-		sub.flair_img.append(username)
+		sub.flair_img.add(userKey(username))
 		print (username + ' added to flair image permission list')
 
 	# Turn user data into a user object
-	def makeUser(sub, user, username, date_created, analysis_time, total_comment_karma, total_post_karma, total_karma, comment_karma_counter, post_karma_counter, pos_comment_counter, neg_comment_counter, pos_post_counter, neg_post_counter, pos_QC_counter, neg_QC_counter):
-		sub.current_users.append(user)
-		return User(sub, username, date_created, analysis_time, total_comment_karma, total_post_karma, total_karma, comment_karma_counter, post_karma_counter, pos_comment_counter, neg_comment_counter, pos_post_counter, neg_post_counter, pos_QC_counter, neg_QC_counter)
-
-	# Turn a string into a dictionary
-	def makeDict(sub, info_str):
-		info_counter = Counter()
-		info_list = info_str.split()
-		while len(info_list) >= 2:
-			info_counter[info_list.pop()] = int(info_list.pop())
-		return info_counter
+	def makeUser(sub, username, date_created, analysis_time, total_comment_karma, total_post_karma, counters):
+		sub.current_users.add(userKey(username))
+		user_info = User(sub, username, date_created, analysis_time, total_comment_karma, total_post_karma, counters)
+		sub.user_cache.put(user_info)
+		return user_info
+
+	# Turn a stored counter into a Counter object
+	# Counters are stored as {abbrev : value} objects, older rows use 'ABBR value ABBR value' strings
+	def makeDict(sub, info):
+		if isinstance(info, dict):
+			return Counter(info)
+		info_list = info.split()
+		return Counter(dict(zip(info_list[0::2], map(int, info_list[1::2]))))
+
+	# Total a user's shared history by this sub's abbreviations and QC settings
+	def projectHistory(sub, username, history, analysis_time):
+		date_created, total_comment_karma, total_post_karma = history['account']
+		counters = dict((name, Counter()) for name in user_counters)
+
+		for sub_name, totals in history['comments'].items():
+			abbrev = sub.all_subs.get(sub_name)
+			if abbrev != None:
+				counters['comment karma'][abbrev] += totals[0]
+				counters['positive comments'][abbrev] += totals[1]
+				counters['negative comments'][abbrev] += totals[2]
+
+		# Histories not yet counted with this sub's QC settings have no QC counts
+		for sub_name, totals in history['qc'].get(sub.qc_profile, {}).items():
+			abbrev = sub.all_subs.get(sub_name)
+			if abbrev != None:
+				counters['positive QC'][abbrev] += totals[0]
+				counters['negative QC'][abbrev] += totals[1]
+
+		for sub_name, totals in history['posts'].items():
+			abbrev = sub.all_subs.get(sub_name)
+			if abbrev != None:
+				counters['post karma'][abbrev] += totals[0]
+				counters['positive posts'][abbrev] += totals[1]
+				counters['negative posts'][abbrev] += totals[2]
+
+		return sub.makeUser(username, date_created, analysis_time, total_comment_karma, total_post_karma, counters)
+
 	# Retrieve a user's data from the database
+	# Stored users are totaled from the shared history, rows from before history was shared hold their own totals
 	def getUserInfo(sub, username):
-		userDB = TinyDB(sub.sub_name + '/userInfo.json')
-		try:
-			info_dict = userDB.search(find_stuff['username'] == username)[0]
-		except IndexError:
+		user_info = sub.user_cache.get(username)
+		if user_info != None:
+			metrics.count('getUserInfo.cache_hit')
+			return user_info
+
+		info_dict = sub.user_db.get(username)
+		if info_dict == None:
+			metrics.count('getUserInfo.miss')
 			return None
 
-		date_created = info_dict['date_created']
-		analysis_time = info_dict['analysis_time']
-		total_comment_karma = info_dict['total_comment_karma']
-		total_post_karma = info_dict['total_post_karma']
-		total_karma = info_dict['total_karma']
-		comment_karma_counter = sub.makeDict(info_dict['comment_karma_counter'])
-		post_karma_counter = sub.makeDict(info_dict['post_karma_counter'])
-		pos_comment_counter = sub.makeDict(info_dict['pos_comment_counter'])
-		neg_comment_counter = sub.makeDict(info_dict['neg_comment_counter'])
-		pos_post_counter = sub.makeDict(info_dict['pos_post_counter'])
-		neg_post_counter = sub.makeDict(info_dict['neg_post_counter'])
-		pos_QC_counter = sub.makeDict(info_dict['pos_QC_counter'])
-		neg_QC_counter = sub.makeDict(info_dict['neg_QC_counter'])
-
-		return User(sub, username, date_created, analysis_time, total_comment_karma, total_post_karma, total_karma, comment_karma_counter, post_karma_counter, pos_comment_counter, neg_comment_counter, pos_post_counter, neg_post_counter, pos_QC_counter, neg_QC_counter)
+		metrics.count('getUserInfo.db_hit')
+		if 'comment_karma_counter' not in info_dict:
+			stored = sub.history_db.get(username)
+			if stored == None or sub.qc_profile not in stored[1]['qc']:
+				return None
+			return sub.projectHistory(username, stored[1], info_dict['analysis_time'])
+
+		counters = {}
+		for name, column in zip(user_counters, legacy_columns):
+			counters[name] = sub.makeDict(info_dict[column])
+		user_info = User(sub, username, info_dict['date_created'], info_dict['analysis_time'], info_dict['total_comment_karma'], info_dict['total_post_karma'], counters)
+		sub.user_cache.put(user_info)
+		return user_info
 
 	# Check if user should be analyzed and if they are accessible
 	def checkUser(sub, user):
-		if user not in sub.whitelist and user not in sub.graylist and user not in sub.expired_users and str(user) not in sub.mods and user not in sub.current_users:
-			try:
-				user.fullname
-			except (prawcore.exceptions.NotFound, AttributeError):
-				return False
-			return True
+		key = userKey(user)
+		if key not in sub.whitelist and key not in sub.graylist and key not in sub.expired_users and key not in sub.mods and key not in sub.current_users:
+			return sub.getAccount(user) != None
 		else:
 			return False
+
+	# Returns the stored (time checked, account) for a user while this sub's settings still reuse it, otherwise None
+	# Details are reused for account_reuse hours and inaccessible accounts are looked up again after inaccessible_recheck hours
+	def cachedAccount(sub, username):
+		stored = sub.account_db.get(username)
+		if stored == None:
+			return None
+		checked, account = stored
+		if account != None:
+			reuse_hours = sub.main_config.get('account_reuse', 24)
+		else:
+			reuse_hours = sub.main_config.get('inaccessible_recheck', 24)
+		if time.time() - checked < reuse_hours * 3600:
+			return stored
+		return None
+
+	# Returns a Redditor, or None for an account found to be inaccessible within inaccessible_recheck hours
+	# Redditors are loaded lazily, so this makes no API request
+	def getRedditor(sub, username):
+		stored = sub.cachedAccount(str(username))
+		if stored != None and stored[1] == None:
+			return None
+		return setUser(username)
+
+	# Returns an account's (created, comment karma, link karma), or None if it is deleted, suspended or shadowbanned
+	# bucket is the token bucket to take from when Reddit has to be asked
+	def getAccount(sub, user, bucket=None):
+		username = str(user)
+		stored = sub.cachedAccount(username)
+		if stored != None:
+			account = stored[1]
+			metrics.count('getAccount.cached' if account != None else 'getAccount.cached_inaccessible')
+			return account
+
+		# The user may have come from another thread's instance
+		user = getReddit().redditor(username)
+		if bucket != None:
+			bucket.acquire()
+		try:
+			account = (user.created, user.comment_karma, user.link_karma)
+			metrics.count('getAccount.fetched')
+		except (prawcore.exceptions.NotFound, AttributeError):
+			account = None
+			metrics.count('getAccount.inaccessible')
+		sub.account_db.save(username, account)
+		return account
 	# Clear the expired database after the users are analyzed
 	def dropExpired(sub):
 		expiredDB = TinyDB(sub.sub_name + '/expired.json')
 		print(str(len(expiredDB)))
-		expiredDB.purge()
+		expiredDB.truncate()
 		sub.expired_users.clear()
 		print('Expired user database was purged')
 
 	# Deletes all the contents of the user info database
 	def wipePM(sub):
-		remInfoDB = TinyDB(sub_name + '/userInfo.json')
-		remInfoDB.purge()
-		remExpiredDB = TinyDB(sub_name + '/expired.json')
-		remExpiredDB.purge()
-		sub.updateSub()
+		# Shared history is used by every sub, so this sub's users are only marked to be fetched from the start again
+		sub.history_db.markStale(sub.user_db.usernames())
+		sub.user_db.purge()
+		sub.user_cache.clear()
+		remExpiredDB = TinyDB(sub.sub_name + '/expired.json')
+		remExpiredDB.truncate()
+		# Users with flair from the bot are re-analyzed so their flair follows the current settings
+		reflair_users = sub.user_db.botFlairUsers()
+		remExpiredDB.insert_multiple([{'username' : username} for username in reflair_users])
+		print (str(len(reflair_users)) + ' users with flair from InstaMod added to expired list')
+		sub.updateSub(sub.sub_name)
 
+	# Full refresh at startup and after a wipe, settings are read from the wiki and user lists from disk
 	def updateSub(sub, sub_name):
 		print('Updating ' + sub_name)
+		start_time = time.time()
+		sub.sub_name = sub_name
+
+		# Read current settings from wiki page, an invalid config stops the sub from loading
+		str_config, revision_id = sub.readConfig()
+		sub.applyConfig(sub.compileConfig(str_config), revision_id)
+
+		# Expired users map their lowercase username to the user so they can be analyzed in order
+		sub.expired_users = {}
+		sub.lock_mode = None
+
+		# Read user lists as plain usernames, Redditor objects are only made when a user is analyzed or messaged
+		sub.whitelist = set(userKey(username) for username in readUsernames(sub_name + '/whitelist.json'))
+		print ('\tRead ' + str(len(sub.whitelist)) + ' users from whitelist')
+		sub.graylist = set(userKey(username) for username in readUsernames(sub_name + '/graylist.json'))
+		print ('\tRead ' + str(len(sub.graylist)) + ' users from greylist')
+
+		for username in readUsernames(sub_name + '/expired.json'):
+			sub.expired_users[userKey(username)] = username
+		print ('\tRead ' + str(len(sub.expired_users)) + ' users from expired list')
+
+		sub.flair_img = set(userKey(username) for username in readUsernames(sub_name + '/flair_img.json'))
+		print ('\tRead ' + str(len(sub.flair_img)) + ' users from flair image permission list')
+
+		sub.maintainSub()
+		metrics.record('updateSub', time.time() - start_time)
+		print ('\tUpdated in ' + str(round(time.time() - start_time, 2)) + ' seconds\n')
+
+	# Hourly upkeep of the stored users, the user lists in memory are kept current as they change
+	def maintainSub(sub):
 		current_time = datetime.now()
-		
-		# Read current settings from wiki page
-		str_config = reddit.subreddit(sub_name).wiki['InstaModSettings'].content_md
+		# Remove users with expired flair in one write and read the remaining current users
+		exp_length = sub.main_config['tag_expiration']
+		removed = sub.user_db.removeBefore(current_time - timedelta(days=exp_length + 1))
+		print ('\tRemoved ' + str(removed) + ' users with old flair')
+		# Stored users are totaled from their history, so it is kept at least as long as the flair of any sub
+		retention = sub.history_db.keepFor(sub.sub_name, max(sub.main_config.get('history_retention', 90), exp_length + 1))
+		sub.history_db.removeBefore(current_time - timedelta(days=retention))
+		sub.shared_qc_profiles = sub.history_db.useProfile(sub.sub_name, sub.qc_profile)
+		# Account details are only kept while some sub could still reuse them
+		sub.account_db.removeBefore(time.time() - max(sub.main_config.get('account_reuse', 24), sub.main_config.get('inaccessible_recheck', 24)) * 3600)
+		sub.current_users = set(userKey(username) for username in sub.user_db.usernames())
+		print ('\tRead ' + str(len(sub.current_users)) + ' current users')
+
+		# Reconcile the local flair copy with the subreddit every flair_reconcile hours
+		reconciled = sub.user_db.getMeta('flair_reconciled')
+		reconcile_hours = sub.main_config.get('flair_reconcile', 24)
+		if reconciled == None or current_time - dateutil.parser.parse(reconciled) >= timedelta(hours=reconcile_hours):
+			sub.startReconcile()
+
+	# The sub's praw object from this thread's Reddit instance
+	def subObj(sub):
+		return getReddit().subreddit(sub.sub_name)
+
+	# Returns the settings wiki page text and its revision ID
+	def readConfig(sub):
+		config_page = sub.subObj().wiki['InstaModSettings']
+		return config_page.content_md, config_page.revision_id
+
+	# Returns the ID of the newest settings revision, a smaller request than the page itself
+	def configRevision(sub):
+		for revision in sub.subObj().wiki['InstaModSettings'].revisions(limit=1):
+			return revision['id']
+		return None
+
+	# Build the settings, compiled rules and caches a config defines without changing the sub
+	# An invalid config raises, naming the setting or rule when it can
+	def compileConfig(sub, str_config):
 		sub_config = literal_eval(str_config)
+		config = {}
 
 		# Sort configuration settings
-		sub.main_config = sub_config['SUB_CONFIG']
-		sub.QC_config = sub_config['QC_CONFIG']
-		sub.progression_config = sub_config['PROGRESS_CONFIG']
-		sub.subtag_config = sub_config['SUBTAG_CONFIG']
-		sub.threadlock_config = sub_config['THREADLOCK_CONFIG']
-		sub.sublock_config = sub_config['SUBLOCK_CONFIG']
-		sub.ratelimit_config = sub_config['RATELIMIT_CONFIG']
+		config['main_config'] = sub_config['SUB_CONFIG']
+		config['QC_config'] = sub_config['QC_CONFIG']
+		config['qc_profile'] = getQCProfile(config['QC_config'])
+		# Builds the QC checks now so invalid QC settings stop the config from loading
+		getQCCounter(config['qc_profile'])
+		config['progression_config'] = sub_config['PROGRESS_CONFIG']
+		config['subtag_config'] = sub_config['SUBTAG_CONFIG']
+		config['threadlock_config'] = sub_config['THREADLOCK_CONFIG']
+		config['sublock_config'] = sub_config['SUBLOCK_CONFIG']
+		config['ratelimit_config'] = sub_config['RATELIMIT_CONFIG']
 
 		# Get subreddit lists
-		sub.A_subs = sub_config['A_SUBS']
-		sub.B_subs = sub_config['B_SUBS']
-		sub.all_subs = sub_config['B_SUBS']
-		sub.all_subs.update(sub.A_subs)
-
-		# Create lists for user databases
-		sub.whitelist = []
-		sub.graylist = []
-		sub.current_users = []
-		sub.expired_users = []
-		sub.users_and_flair = {}
-		sub.flair_img = []
-		sub.lock_mode = None
-		sub.ratelimit = Counter()
+		config['A_subs'] = sub_config['A_SUBS']
+		config['B_subs'] = sub_config['B_SUBS']
+		config['all_subs'] = dict(sub_config['B_SUBS'])
+		config['all_subs'].update(config['A_subs'])
 
 		# Store subreddit info
-		sub.mods = sub.main_config['mods']
-		sub.sub_name = sub_name
-		sub.sub_abbrev = sub_config['SUB_CONFIG']['abbrev']
-		sub.sub_obj = reddit.subreddit(sub_name)
-
-		# Read whitelist
-		whitelistDB = TinyDB(sub_name + '/whitelist.json')
-		for username in whitelistDB:
-			user = setUser(username['username'])
-			if user != None:
-				sub.whitelist.append(user)
-		print ('\tRead ' + str(len(sub.whitelist)) + ' users from whitelist')
-	
-		# Read graylist
-		graylistDB = TinyDB(sub_name + '/graylist.json')
-		for username in graylistDB:
-			user = setUser(username['username'])
-			if user != None:
-				sub.graylist.append(user)
-		print ('\tRead ' + str(len(sub.graylist)) + ' users from greylist')
+		config['mods'] = set(userKey(mod) for mod in config['main_config']['mods'])
+		config['sub_abbrev'] = config['main_config']['abbrev']
 
-		# Read current users
-		currentDB = TinyDB(sub_name + '/userInfo.json')
-		for user_info in currentDB:
-			tdelta = current_time - dateutil.parser.parse(user_info['analysis_time'])
-			exp_length = sub.main_config['tag_expiration']
-			#remove users with expired flair and add current users to list
-			if tdelta.days > exp_length:
-				print ('\t' + user_info['username'] + ' has old flair')
-				currentDB.remove(find_stuff['username'] == user_info['username'])
-			else:
-				user = setUser(user_info['username'])
-				#check if user is valid
-				if user != None:
-					sub.current_users.append(user)
-		print ('\tRead ' + str(len(sub.current_users)) + ' current users')
+		# Compile rules against the new settings, an invalid rule raises a ValueError naming it
+		pending = SimpleNamespace(**config)
+		config['progression_rules'] = compileRules(pending, 'PROGRESS_CONFIG', config['progression_config'], 'tier', TierRule)
+		config['subtag_rules'] = compileRules(pending, 'SUBTAG_CONFIG', config['subtag_config'], 'subtag', SubTagRule)
+		config['sublock_rules'] = compileRules(pending, 'SUBLOCK_CONFIG', config['sublock_config'], 'sublock', LockRule)
+		config['ratelimit_rules'] = compileRules(pending, 'RATELIMIT_CONFIG', config['ratelimit_config'], 'comments', RatelimitRule)
+		# Thread locks are looked up by post flair, the first rule for a flair wins
+		config['threadlock_rules'] = {}
+		for lock_rule in compileRules(pending, 'THREADLOCK_CONFIG', config['threadlock_config'], 'threadlock', LockRule):
+			config['threadlock_rules'].setdefault(lock_rule.lock_ID, lock_rule)
 
-		# Read expired users
-		expiredDB = TinyDB(sub_name + '/expired.json')
-		for username in expiredDB:
-			user = setUser(username['username'])
-			if user != None:
-				sub.expired_users.append(user)
-		print ('\tRead ' + str(len(sub.expired_users)) + ' users from expired list')
+		# Cached users are totaled by abbreviation and QC settings, so they are only dropped when those change
+		cache_settings = (config['all_subs'], config['qc_profile'], config['main_config'].get('user_cache_size', 5000), config['main_config']['tag_expiration'])
+		if getattr(sub, 'cache_settings', None) == cache_settings:
+			config['user_cache'] = sub.user_cache
+		else:
+			config['user_cache'] = UserCache(cache_settings[2], cache_settings[3])
+		config['cache_settings'] = cache_settings
+		return config
+
+	# Swap in settings from compileConfig in one update, so a comment sees either the old or the new settings
+	def applyConfig(sub, config, revision_id):
+		sub.__dict__.update(config)
+		sub.config_revision = revision_id
+		sub.config_checked = time.time()
+		sub.shared_qc_profiles = sub.history_db.useProfile(sub.sub_name, sub.qc_profile)
+		# Each ratelimit rule counts comments over its own interval
+		sub.ratelimiter.setIntervals([rate_rule.interval * 3600.0 for rate_rule in sub.ratelimit_rules])
 
-		# Read users with image flair permissions
-		flair_imgDB = TinyDB(sub_name + '/flair_img.json')
-		for username in flair_imgDB:
-			user = setUser(username['username'])
-			if user != None:
-				sub.flair_img.append(user)
-		print ('\tRead ' + str(len(sub.flair_img)) + ' users from flair image permission list\n')
+	# Settings that decide the flair a user's totals give them, stored users are re-tiered when these change
+	# QC settings are left out, stored totals have no QC counts for new settings until each user is analyzed again
+	def flairSettings(sub):
+		return (sub.progression_config, sub.subtag_config, sub.all_subs, sub.main_config['sub_progression'], sub.main_config['sub_tags'], sub.main_config['accnt_age'])
+
+	# Reload the config if the wiki page has a new revision, checked every config_poll seconds
+	# Returns True if new settings were applied, an invalid config is reported and the current settings are kept
+	def checkConfig(sub, force=False):
+		if not force and time.time() - sub.config_checked < sub.main_config.get('config_poll', 3600):
+			return False
+		sub.config_checked = time.time()
+		revision_id = sub.configRevision()
+		if revision_id == sub.config_revision:
+			metrics.count('checkConfig.unchanged')
+			return False
+
+		start_time = time.time()
+		str_config, revision_id = sub.readConfig()
+		try:
+			config = sub.compileConfig(str_config)
+		except (ValueError, SyntaxError, KeyError, TypeError) as error:
+			# The revision is remembered so a broken config is only reported once
+			sub.config_revision = revision_id
+			metrics.count('checkConfig.invalid')
+			print('Kept current settings for ' + sub.sub_name + ', config revision ' + str(revision_id) + ' is invalid: ' + repr(error))
+			return False
+		cache_kept = config['user_cache'] is sub.user_cache
+		sub.applyConfig(config, revision_id)
+		metrics.count('checkConfig.applied')
+		metrics.record('checkConfig', time.time() - start_time)
+		print('Applied config revision ' + str(revision_id) + ' for ' + sub.sub_name + (', user cache kept' if cache_kept else ', user cache cleared'))
+		return True
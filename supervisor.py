@@ -0,0 +1,62 @@
+# Runs the auto command as several worker processes, each streaming its own share of the subs
+# Workers are started as 'InstaMod.py auto' with INSTAMOD_SITE naming their praw.ini credentials and INSTAMOD_SUBS listing their subs
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Split subs round robin so each worker gets a similar number
+def shardSubs(sub_list, worker_count):
+	shards = [sub_list[i::worker_count] for i in range(worker_count)]
+	return [shard for shard in shards if len(shard) > 0]
+
+# praw.ini site for each worker, from INSTAMOD_SITES or InstaMod1, InstaMod2, etc
+def workerSites(worker_count):
+	sites = os.environ.get('INSTAMOD_SITES')
+	if sites == None:
+		return ['InstaMod' + str(i + 1) for i in range(worker_count)]
+	sites = [site.strip() for site in sites.split(',') if site.strip() != '']
+	if len(sites) < worker_count:
+		raise ValueError('INSTAMOD_SITES names ' + str(len(sites)) + ' praw.ini sites for ' + str(worker_count) + ' workers')
+	return sites
+
+def startWorker(script, index, site, subs):
+	env = dict(os.environ)
+	env['INSTAMOD_SITE'] = site
+	env['INSTAMOD_SUBS'] = ','.join(subs)
+	# Each worker serves and writes its own metrics
+	if 'INSTAMOD_METRICS_PORT' in env:
+		env['INSTAMOD_METRICS_PORT'] = str(int(env['INSTAMOD_METRICS_PORT']) + index)
+	for setting in ('INSTAMOD_METRICS_FILE', 'INSTAMOD_PROFILE'):
+		if setting in env:
+			env[setting] += '.' + site
+	print('Starting worker ' + site + ' for ' + ', '.join(subs))
+	return subprocess.Popen([sys.executable, script, 'auto'], env=env)
+
+# Start a worker for each shard of subs and restart any that exit
+# Workers are stopped when the supervisor exits for any reason, SIGTERM is handled like Ctrl-C
+def supervise(script, sub_list, worker_count):
+	signal.signal(signal.SIGTERM, signal.default_int_handler)
+	shards = shardSubs(sub_list, worker_count)
+	sites = workerSites(len(shards))
+	workers = []
+	try:
+		for index, (site, subs) in enumerate(zip(sites, shards)):
+			workers.append([index, site, subs, startWorker(script, index, site, subs)])
+		while True:
+			time.sleep(10)
+			for worker in workers:
+				exit_code = worker[3].poll()
+				if exit_code != None:
+					print('Worker ' + worker[1] + ' exited with code ' + str(exit_code) + ', restarting')
+					worker[3] = startWorker(script, worker[0], worker[1], worker[2])
+	except KeyboardInterrupt:
+		pass
+	finally:
+		print('Stopping workers')
+		for worker in workers:
+			if worker[3].poll() == None:
+				worker[3].terminate()
+		for worker in workers:
+			worker[3].wait()
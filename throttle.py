@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import OrderedDict
+from metrics import metrics
+
+# Token bucket shared by every thread that makes Reddit API requests
+# The refill rate follows the rate limit headers from Reddit, which praw exposes through auth.limits
+class TokenBucket:
+	def __init__(bucket, reddit, capacity=10, default_rate=1.0):
+		bucket.reddit = reddit
+		bucket.capacity = capacity
+		bucket.rate = default_rate
+		bucket.tokens = float(capacity)
+		bucket.last_refill = time.time()
+		bucket.lock = threading.Lock()
+
+	# Spread the requests left in the current rate limit window over the time until it resets
+	def sync(bucket):
+		limits = bucket.reddit.auth.limits
+		remaining = limits.get('remaining')
+		reset_timestamp = limits.get('reset_timestamp')
+		if remaining == None or reset_timestamp == None:
+			return
+		window = max(reset_timestamp - time.time(), 1.0)
+		bucket.rate = max(remaining, 1) / window
+
+	# Block until a token is available for one API request
+	def acquire(bucket):
+		metrics.count('api.requests')
+		wait_start = time.time()
+		while True:
+			with bucket.lock:
+				bucket.sync()
+				now = time.time()
+				bucket.tokens = min(bucket.capacity, bucket.tokens + (now - bucket.last_refill) * bucket.rate)
+				bucket.last_refill = now
+				if bucket.tokens >= 1:
+					bucket.tokens -= 1
+					metrics.record('api.wait', time.time() - wait_start)
+					return
+				wait = (1 - bucket.tokens) / bucket.rate
+			time.sleep(wait)
+
+# Yields items from a praw listing, taking a token before each page of 100 is requested
+def throttled(listing, bucket):
+	bucket.acquire()
+	for count, item in enumerate(listing, 1):
+		yield item
+		if count % 100 == 0:
+			bucket.acquire()
+
+# Per-user comment counts for the ratelimit rules, one sliding window for each rule interval
+# Each window keeps the count for the current and previous fixed window and weights the previous one by how much of it
+# still overlaps the sliding window, so recording and checking a comment is constant time for any comment rate
+# Users are kept in order of their last comment, so users idle longer than every window are evicted from the front
+class CommentLimiter:
+	def __init__(limiter, max_users=100000):
+		limiter.max_users = max_users
+		limiter.intervals = ()
+		limiter.users = OrderedDict()
+		limiter.dirty = set()
+
+	# Window lengths in seconds, windows for intervals no longer used are dropped as users comment
+	def setIntervals(limiter, intervals):
+		limiter.intervals = tuple(sorted(set(intervals)))
+
+	def idleTime(limiter):
+		if len(limiter.intervals) == 0:
+			return 0
+		return 2 * limiter.intervals[-1]
+
+	# Load saved state as (user key, last comment time, windows)
+	def load(limiter, rows):
+		for user_key, last_seen, windows in sorted(rows, key=lambda row: row[1]):
+			limiter.users[user_key] = [last_seen, dict((interval, window) for interval, window in windows)]
+		limiter.evict(time.time())
+
+	# Drop users whose newest comment is outside every window, and the least recent users over max_users
+	def evict(limiter, now):
+		users = limiter.users
+		idle_time = limiter.idleTime()
+		while len(users) > 0:
+			user_key, state = next(iter(users.items()))
+			if len(users) <= limiter.max_users and now - state[0] < idle_time:
+				break
+			users.popitem(last=False)
+			limiter.dirty.discard(user_key)
+
+	# Count a comment from the user in every window
+	def record(limiter, user_key, now=None):
+		if now == None:
+			now = time.time()
+		state = limiter.users.pop(user_key, None)
+		if state == None:
+			state = [now, {}]
+		state[0] = now
+		windows = {}
+		for interval in limiter.intervals:
+			window = limiter.roll(state[1].get(interval), interval, now)
+			window[2] += 1
+			windows[interval] = window
+		state[1] = windows
+		limiter.users[user_key] = state
+		limiter.dirty.add(user_key)
+		limiter.evict(now)
+
+	# Move a [window number, previous count, current count] window forward to the window holding now
+	def roll(limiter, window, interval, now):
+		number = int(now // interval)
+		if window == None or window[0] < number - 1:
+			return [number, 0, 0]
+		if window[0] == number - 1:
+			return [number, window[2], 0]
+		return window
+
+	# Estimated comments from the user in the last interval seconds
+	def count(limiter, user_key, interval, now=None):
+		if now == None:
+			now = time.time()
+		state = limiter.users.get(user_key)
+		if state == None or interval not in state[1]:
+			return 0
+		window = limiter.roll(list(state[1][interval]), interval, now)
+		overlap = 1 - (now - window[0] * interval) / interval
+		return window[2] + window[1] * overlap
+
+	# Returns state changed since the last call as (user key, last comment time, windows)
+	def changes(limiter):
+		rows = []
+		for user_key in limiter.dirty:
+			state = limiter.users[user_key]
+			rows.append((user_key, state[0], list(state[1].items())))
+		limiter.dirty = set()
+		return rows
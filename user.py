@@ -1,20 +1,6 @@
-import praw
-import prawcore
-import json
 from collections import Counter
 from datetime import datetime, date
 from dateutil import relativedelta
-import dateutil.parser
-from tinydb import TinyDB, Query
-
-#save current time
-current_time = datetime.now()
-
-#start instance of Reddit
-reddit = praw.Reddit('InstaMod')
-
-#initialize sub specific global variables
-find_stuff = Query()
 
 #convert datetime so databse can read it
 def json_serial(obj):
@@ -22,109 +8,74 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError ("Type %s not serializable" % type(obj))
 
-def setUser(username):
-	try:
-		return reddit.redditor(username)
-	except (prawcore.exceptions.NotFound, AttributeError):
-		return None
+# Metrics kept as a Counter by subreddit abbreviation, each user has all of them except net QC
+user_counters = ('comment karma', 'post karma', 'positive comments', 'negative comments', 'positive posts', 'negative posts', 'positive QC', 'negative QC')
 
+# One user's totals as a sub sees them
+# Net QC, months old and metric totals are worked out the first time a rule asks for them and kept after that
+# Making a User has no side effects, save() records the analysis in the sub's user database
 class User:
-	def __init__(user_info, parent_sub, username, date_created, analysis_time, total_comment_karma, total_post_karma, total_karma, comment_karma_counter, post_karma_counter, pos_comment_counter, neg_comment_counter, pos_post_counter, neg_post_counter, pos_QC_counter, neg_QC_counter):
+	__slots__ = ('parent_sub', 'username', 'date_created', 'analysis_time', 'total_comment_karma', 'total_post_karma', 'counters', '_net_QC', '_months_old', '_totals')
+
+	# counters maps each name in user_counters to a Counter by abbreviation
+	def __init__(user_info, parent_sub, username, date_created, analysis_time, total_comment_karma, total_post_karma, counters):
 		user_info.parent_sub = parent_sub
 		user_info.username = username
 		user_info.date_created = date_created
 		user_info.analysis_time = analysis_time
 		user_info.total_comment_karma = total_comment_karma
 		user_info.total_post_karma = total_post_karma
-		user_info.total_karma = total_karma
-		
-		user_info.comment_karma_counter = comment_karma_counter
-			
-		user_info.post_karma_counter = post_karma_counter
-		
-		user_info.pos_comment_counter = pos_comment_counter
-			
-		user_info.neg_comment_counter = neg_comment_counter
-			
-		user_info.pos_post_counter = pos_post_counter
-			
-		user_info.neg_post_counter = neg_post_counter
-			
-		user_info.pos_QC_counter = pos_QC_counter
-			
-		user_info.neg_QC_counter = neg_QC_counter
-			
-		user_info.net_QC_counter = Counter()
-		for sub in pos_QC_counter:
-			user_info.net_QC_counter[sub] = pos_QC_counter[sub]
-		for sub in neg_QC_counter:
-			user_info.net_QC_counter[sub] -= neg_QC_counter[sub]
-		
+		user_info.counters = counters
+		user_info._net_QC = None
+		user_info._months_old = None
+		user_info._totals = None
+
+	@property
+	def total_karma(user_info):
+		return user_info.total_comment_karma + user_info.total_post_karma
+
+	@property
+	def net_QC_counter(user_info):
+		if user_info._net_QC == None:
+			net_QC_counter = Counter(user_info.counters['positive QC'])
+			net_QC_counter.subtract(user_info.counters['negative QC'])
+			user_info._net_QC = net_QC_counter
+		return user_info._net_QC
+
+	@property
+	def months_old(user_info):
+		if user_info._months_old == None:
+			tdelta = relativedelta.relativedelta(datetime.now(), datetime.fromtimestamp(user_info.date_created))
+			user_info._months_old = tdelta.months
+		return user_info._months_old
+
+	# A rule metric, a Counter by abbreviation or a number for the account totals
+	def metric(user_info, name):
+		if name == 'net QC':
+			return user_info.net_QC_counter
+		elif name == 'total comment karma':
+			return user_info.total_comment_karma
+		elif name == 'total post karma':
+			return user_info.total_post_karma
+		elif name == 'total karma':
+			return user_info.total_karma
+		elif name == 'months old':
+			return user_info.months_old
+		return user_info.counters[name]
+
+	# A counter metric totaled over a frozenset of abbreviations
+	def total(user_info, name, target_subs):
+		if user_info._totals == None:
+			user_info._totals = {}
+		key = (name, target_subs)
+		value = user_info._totals.get(key)
+		if value == None:
+			value = user_info._totals[key] = sum(count for abbrev, count in user_info.metric(name).items() if abbrev in target_subs)
+		return value
 
-		tdelta = relativedelta.relativedelta(datetime.now(), user_info.date_created)
-		months_old = tdelta.months
-		
-		user_info.info_dict = {
-			'parent_sub' : parent_sub,
-			'username' : username,
-			'date created' : date_created,
-			'months old' : months_old,
-			'analysis time' : analysis_time,
-			'comment karma' : comment_karma_counter,
-			'post karma' : post_karma_counter,
-			'total comment karma' : total_comment_karma,
-			'total post karma' : total_post_karma,
-			'total karma' : total_karma,
-			'positive comments' : pos_comment_counter,
-			'negative comments' : neg_comment_counter,
-			'positive posts' : pos_post_counter,
-			'negative posts' : neg_post_counter,
-			'positive QC' : pos_QC_counter,
-			'negative QC' : neg_QC_counter,
-			'net QC' : user_info.net_QC_counter
-		}	
-		
-		userDB = TinyDB(parent_sub.sub_name + '/userInfo.json')
-		if userDB.search(find_stuff.username == username):
-			pass
-		else:
-			comment_karma_str = ''
-			for sub in comment_karma_counter:
-				comment_karma_str += (sub + ' ' + str(comment_karma_counter[sub]) + ' ')
-				
-			post_karma_str = ''
-			for sub in post_karma_counter:
-				post_karma_str += (sub + ' ' + str(post_karma_counter[sub]) + ' ')
-				
-			pos_comment_str = ''
-			for sub in pos_comment_counter:
-				pos_comment_str += (sub + ' ' + str(pos_comment_counter[sub]) + ' ')
-			
-			neg_comment_str = ''
-			for sub in neg_comment_counter:
-				neg_comment_str += (sub + ' ' + str(neg_comment_counter[sub]) + ' ')
-				
-			pos_post_str = ''
-			for sub in pos_post_counter:
-				pos_post_str += (sub + ' ' + str(pos_post_counter[sub]) + ' ')
-				
-			neg_post_str = ''
-			for sub in neg_post_counter:
-				neg_post_str += (sub + ' ' + str(neg_post_counter[sub]) + ' ')
-				
-			pos_QC_str = ''
-			for sub in pos_QC_counter:
-				pos_QC_str += (sub + ' ' + str(pos_QC_counter[sub]) + ' ')
-				
-			neg_QC_str = ''
-			for sub in neg_QC_counter:
-				neg_QC_str += (sub + ' ' + str(neg_QC_counter[sub]) + ' ')
-			
-			net_QC_str = ''
-			for sub in user_info.net_QC_counter:
-				net_QC_str += (sub + ' ' + str(user_info.net_QC_counter[sub]) + ' ')
-				
-			#str_created = json_serial(date_created)
-			str_analyzed = json_serial(analysis_time)
-			userDB.insert({'username' : username, 'date_created' : date_created, 'analysis_time' : str_analyzed, 'total_comment_karma' : total_comment_karma, 'total_post_karma' : total_post_karma, 'total_karma' : total_karma, 'comment_karma_counter' : comment_karma_str, 'post_karma_counter' : post_karma_str, 'pos_comment_counter' : pos_comment_str, 'neg_comment_counter' : neg_comment_str, 'pos_post_counter' : pos_post_str, 'neg_post_counter' : neg_post_str, 'pos_QC_counter' : pos_QC_str, 'neg_QC_counter' : neg_QC_str, 'net_QC_counter' : net_QC_str})
-			
\ No newline at end of file
+	# Record when the user was analyzed if the sub has no row for them
+	# Totals are kept in the shared history, so the row only records when the user was analyzed
+	def save(user_info):
+		user_db = user_info.parent_sub.user_db
+		if user_info.username not in user_db:
+			user_db.insert({'username' : user_info.username, 'analysis_time' : json_serial(user_info.analysis_time)})